@@ -0,0 +1,115 @@
+import sys
+import os
+import argparse
+import time
+import json
+
+# Add directories to sys.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+from ndvi_image_functions import calculate_ndvi, normalize_ndvi
+from ndvi_kernel import ndvi_to_byte, HAVE_NUMBA
+
+PARITY_DTYPES = ('uint8', 'uint16', 'int16', 'int32', 'float32', 'float64')
+
+#The pre-kernel chain: float64 scaling, calculate_ndvi, normalize_ndvi and the masks from export_ndvi_image
+def reference_chain(red, nir):
+    ndvi = calculate_ndvi(red / 10000.0, nir / 10000.0)
+    ndvi_normalized = normalize_ndvi(ndvi)
+    binmask = np.where(ndvi_normalized > 0, 1, 0)
+    clipped_data = np.where(binmask != 0, ndvi_normalized, np.nan)
+    clipped_data[np.isnan(clipped_data)] = 0
+    # GDAL clamps the int64 array into Byte when writing
+    return np.clip(ndvi_normalized, 0, 255).astype(np.uint8)
+
+#Bands of every input dtype the kernel accepts, with the edge cases of the encoding: both bands 0, bands of opposite sign
+#that sum to 0 (signed dtypes), and NaN (float dtypes)
+def parity_bands(dtype, shape, rng):
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        red = rng.uniform(-20000, 20000, shape).astype(dtype)
+        nir = rng.uniform(-20000, 20000, shape).astype(dtype)
+    else:
+        low = 0 if dtype.kind == 'u' else -20000
+        red = rng.integers(low, 20000, shape).astype(dtype)
+        nir = rng.integers(low, 20000, shape).astype(dtype)
+    rows = shape[0] // 4
+    red[:rows], nir[:rows] = 0, 0
+    if dtype.kind != 'u':
+        nir[rows:2 * rows] = -red[rows:2 * rows]
+    if dtype.kind == 'f':
+        red[2 * rows:2 * rows + 2] = np.nan
+    return red, nir
+
+#numpy and numba backends must give the same bytes for every dtype; returns the mismatching pixel count per dtype
+def check_backend_parity(shape=(256, 256), seed=0):
+    rng = np.random.default_rng(seed)
+    mismatches = {}
+    for dtype in PARITY_DTYPES:
+        red, nir = parity_bands(dtype, shape, rng)
+        numpy_result = ndvi_to_byte(red, nir, backend='numpy')
+        numba_result = ndvi_to_byte(red, nir, backend='numba')
+        mismatches[dtype] = int(np.count_nonzero(numpy_result != numba_result))
+    return mismatches
+
+def time_call(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the fused NDVI kernel with calculate_ndvi/normalize_ndvi')
+    parser.add_argument('--size', type=int, default=4000, help='Scene edge length in pixels (default: 4000)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed repetitions, best is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    shape = (args.size, args.size)
+    red = rng.integers(0, 20000, shape, dtype=np.uint16)
+    nir = rng.integers(0, 20000, shape, dtype=np.uint16)
+    red[:args.size // 10] = 0
+    nir[:args.size // 10] = 0
+
+    out = np.empty(shape, dtype=np.uint8)
+    backends = ['numpy'] + (['numba'] if HAVE_NUMBA else [])
+    if 'numba' in backends:
+        ndvi_to_byte(red[:2, :2], nir[:2, :2], backend='numba')  # compile outside the timing
+
+    reference_time, reference = time_call(lambda: reference_chain(red, nir), args.repeat)
+    megapixels = red.size / 1e6
+    results = {'size': args.size, 'megapixels': megapixels, 'reference_s': reference_time, 'backends': {}}
+
+    for backend in backends:
+        elapsed, result = time_call(lambda: ndvi_to_byte(red, nir, out=out, backend=backend), args.repeat)
+        diff = np.abs(result.astype(np.int16) - reference.astype(np.int16))
+        results['backends'][backend] = {
+            'seconds': elapsed,
+            'megapixels_per_s': megapixels / elapsed,
+            'speedup': reference_time / elapsed,
+            'mismatched_pixels': int(np.count_nonzero(diff)),
+            'max_abs_diff': int(diff.max()),
+            'nodata_matches': bool(np.array_equal(result == 0, reference == 0)),
+        }
+
+    if HAVE_NUMBA:
+        results['backend_parity'] = check_backend_parity(seed=args.seed)
+
+    print(json.dumps(results, indent=2))
+    failed = False
+    for backend, result in results['backends'].items():
+        if result['mismatched_pixels']:
+            print(f"{backend} kernel differs from the original chain on {result['mismatched_pixels']} pixels", file=sys.stderr)
+            failed = True
+    if HAVE_NUMBA and any(results['backend_parity'].values()):
+        print(f"numpy and numba kernels differ: {results['backend_parity']}", file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
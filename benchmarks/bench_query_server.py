@@ -0,0 +1,178 @@
+import sys
+import os
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+import tempfile
+import time
+import urllib.parse
+
+# Add directories to sys.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+from raster_catalog import get_catalog_path, query_scenes
+from synthetic_archive import make_ndvi_archive
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#Random point and small-square range queries inside the archive's footprint and date span
+def build_queries(archive, count, distinct, range_fraction, seed):
+    scenes = query_scenes(get_catalog_path(archive), '0001-01-01', '9999-12-31', [-180, -90, 180, 90])
+    if not scenes:
+        raise SystemExit(f"No scenes cataloged in {archive}")
+    mbrs = np.array([scene['mbr'] for scene in scenes])
+    min_lon, min_lat = mbrs[:, 0].min(), mbrs[:, 1].min()
+    max_lon, max_lat = mbrs[:, 2].max(), mbrs[:, 3].max()
+    start, end = scenes[0]['date'], scenes[-1]['date']
+
+    rng = np.random.default_rng(seed)
+    pool = []
+    for _ in range(distinct):
+        lon, lat = rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)
+        if rng.random() < range_fraction:
+            half = 0.002
+            wkt = (f"POLYGON(({lon - half} {lat - half}, {lon + half} {lat - half}, {lon + half} {lat + half}, "
+                   f"{lon - half} {lat + half}, {lon - half} {lat - half}))")
+            pool.append(('range', '/range?' + urllib.parse.urlencode({'wkt': wkt, 'start': start, 'end': end})))
+        else:
+            pool.append(('point', '/point?' + urllib.parse.urlencode({'lat': lat, 'lon': lon, 'start': start, 'end': end})))
+    return [pool[i] for i in rng.integers(0, len(pool), count)]
+
+async def open_connection(args):
+    if args.socket:
+        return await asyncio.open_unix_connection(args.socket)
+    return await asyncio.open_connection(args.host, args.port)
+
+async def request(reader, writer, target):
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    body = await reader.readexactly(length)
+    return status, body
+
+#Each connection sends its share of the queries back to back over one keep-alive connection
+async def run_load(args, queries):
+    latencies = {'point': [], 'range': []}
+    errors = 0
+    queue = asyncio.Queue()
+    for query in queries:
+        queue.put_nowait(query)
+
+    async def worker():
+        nonlocal errors
+        reader, writer = await open_connection(args)
+        try:
+            while not queue.empty():
+                kind, target = queue.get_nowait()
+                started = time.perf_counter()
+                status, _ = await request(reader, writer, target)
+                latencies[kind].append(time.perf_counter() - started)
+                if status != 200:
+                    errors += 1
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+async def fetch_health(args):
+    reader, writer = await open_connection(args)
+    try:
+        _, body = await request(reader, writer, '/health')
+    finally:
+        writer.close()
+    return json.loads(body)
+
+def summarize(latencies):
+    if not latencies:
+        return None
+    ms = np.array(latencies) * 1000
+    return {'requests': len(ms), 'p50_ms': float(np.percentile(ms, 50)), 'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+def start_server(args):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        args.port = probe.getsockname()[1]
+    command = [sys.executable, os.path.join(REPO_DIR, 'timeseries.py'), 'serve', '-i', args.archive,
+               '--port', str(args.port), '-q']
+    if args.jobs:
+        command += ['-j', str(args.jobs)]
+    process = subprocess.Popen(command)
+
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited with code {process.returncode}")
+        try:
+            asyncio.run(fetch_health(args))
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("Server did not start within 120 s")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the timeseries.py query server: p50/p99 latency and QPS')
+    parser.add_argument('--archive', type=str, help='NDVI archive to query (default: a synthetic archive in a temp directory)')
+    parser.add_argument('--dates', type=int, default=24, help='Synthetic archive dates (default: 24)')
+    parser.add_argument('--scenes', type=int, default=4, help='Synthetic archive scenes per date (default: 4)')
+    parser.add_argument('--size', type=int, default=1024, help='Synthetic scene edge length in pixels (default: 1024)')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='Port of a running server (default: start one on a free port)')
+    parser.add_argument('--socket', type=str, help='Unix socket of a running server')
+    parser.add_argument('-j', '--jobs', type=int, help='Query threads of the started server')
+    parser.add_argument('--requests', type=int, default=2000, help='Measured requests (default: 2000)')
+    parser.add_argument('--warmup', type=int, default=100, help='Unmeasured requests sent first (default: 100)')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent keep-alive connections (default: 16)')
+    parser.add_argument('--distinct', type=int, default=500, help='Distinct queries the requests are drawn from (default: 500)')
+    parser.add_argument('--range-fraction', type=float, default=0.1, help='Share of range queries (default: 0.1)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    temp_dir = None
+    if args.archive is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix='ndvi_bench_')
+        args.archive = temp_dir.name
+        make_ndvi_archive(args.archive, args.dates, args.scenes, args.size, seed=args.seed)
+
+    process = None
+    if args.port is None and args.socket is None:
+        process = start_server(args)
+    try:
+        queries = build_queries(args.archive, args.warmup + args.requests, args.distinct, args.range_fraction, args.seed)
+        asyncio.run(run_load(args, queries[:args.warmup]))
+        latencies, errors, elapsed = asyncio.run(run_load(args, queries[args.warmup:]))
+        results = {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'errors': errors,
+            'seconds': elapsed,
+            'qps': args.requests / elapsed,
+            'all': summarize(latencies['point'] + latencies['range']),
+            'point': summarize(latencies['point']),
+            'range': summarize(latencies['range']),
+            'server': asyncio.run(fetch_health(args)),
+        }
+        print(json.dumps(results, indent=2))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import sys
+import os
+import argparse
+import json
+import subprocess
+import tempfile
+import time
+
+# Add directories to sys.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+from synthetic_archive import make_ndvi_archive
+from raster_catalog import query_scenes
+
+REPO_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+TIMESERIES = os.path.join(REPO_DIR, 'timeseries.py')
+# Modules a point query must not load; each one costs 0.1-0.8 s of cold start
+HEAVY_MODULES = ('geopandas', 'shapely', 'pandas', 'pyarrow', 'rioxarray', 'xarray', 'osgeo', 'numba', 'unittest')
+MODULES = ('time_series_functions', 'output_functions', 'query_server', 'ndvi_image_functions')
+
+# Runs in a fresh interpreter: times the body and reports which heavy modules it loaded as the last line of stdout
+_CHILD = '''
+import sys, time, json, runpy
+started = time.perf_counter()
+sys.path.insert(0, {src!r})
+sys.argv = {argv!r}
+try:
+    {body}
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - started
+print(json.dumps({{'seconds': elapsed, 'heavy_modules': sorted(m for m in {heavy!r} if m in sys.modules)}}))
+'''
+
+def run_child(body, argv=(), cwd=None):
+    code = _CHILD.format(src=SRC_DIR, argv=list(argv), body=body, heavy=HEAVY_MODULES)
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"Startup child failed:\n{result.stderr}")
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['wall'] = wall
+    return report
+
+#Median of `repeat` cold runs; wall_ms includes the interpreter's own start, body_ms is the imports and work alone
+def measure(body, argv=(), cwd=None, repeat=5):
+    reports = [run_child(body, argv, cwd) for _ in range(repeat)]
+    return {'wall_ms': float(np.median([r['wall'] for r in reports]) * 1000),
+            'body_ms': float(np.median([r['seconds'] for r in reports]) * 1000),
+            'heavy_modules': reports[0]['heavy_modules']}
+
+#Slowest imports of one command from python -X importtime: cumulative time of the modules it imports and of their direct imports
+def slowest_imports(argv, cwd=None, top=15):
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + list(argv), cwd=cwd, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            imports.append((int(cumulative), name.strip(), depth))
+    return [{'module': name, 'depth': depth, 'cumulative_ms': us / 1000} for us, name, depth in sorted(imports, reverse=True)[:top]]
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold start of timeseries.py and the core modules in fresh interpreters')
+    parser.add_argument('--repeat', type=int, default=5, help='Fresh interpreters per measurement, the median is reported (default: 5)')
+    parser.add_argument('--top', type=int, default=0, help='Also list the N slowest imports of the point query (python -X importtime)')
+    parser.add_argument('--budget-ms', type=float, help='Exit with status 1 when the point query takes longer than this (wall time)')
+    parser.add_argument('--baseline', type=str, help='Earlier result JSON to compare against')
+    parser.add_argument('-o', '--output', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {'python': sys.version.split()[0], 'repeat': args.repeat, 'modules': {}}
+    results['interpreter'] = measure('pass', repeat=args.repeat)
+    for module in MODULES:
+        try:
+            results['modules'][module] = measure(f'import {module}', repeat=args.repeat)
+        except RuntimeError as e:
+            # ndvi_image_functions needs GDAL only when a scene is converted, but its imports may still be missing here
+            results['modules'][module] = {'error': str(e).splitlines()[-1]}
+
+    with tempfile.TemporaryDirectory(prefix='ndvi_startup_') as workdir:
+        archive = os.path.join(workdir, 'ndvi')
+        catalog_path = make_ndvi_archive(archive, dates=4, scenes=1, size=64)
+        min_lon, min_lat, max_lon, max_lat = query_scenes(catalog_path, '2020-01-01', '2020-12-31', [-180, -90, 180, 90])[0]['mbr']
+        results['help'] = measure(f'runpy.run_path({TIMESERIES!r}, run_name="__main__")', ['timeseries.py', '--help'], workdir, args.repeat)
+        point_argv = ['timeseries.py', '-i', archive, '-s', '2020-01-01', '-e', '2020-12-31', '-p', str((min_lat + max_lat) / 2), str((min_lon + max_lon) / 2), '-q']
+        results['point_query'] = measure(f'runpy.run_path({TIMESERIES!r}, run_name="__main__")', point_argv, workdir, args.repeat)
+        if args.top:
+            results['point_query']['slowest_imports'] = slowest_imports([TIMESERIES] + point_argv[1:], workdir, args.top)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        results['baseline'] = {key: results[key]['wall_ms'] / baseline[key]['wall_ms']
+                               for key in ('interpreter', 'help', 'point_query') if baseline.get(key, {}).get('wall_ms')}
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    failures = []
+    if results['point_query']['heavy_modules']:
+        failures.append(f"point query loaded {results['point_query']['heavy_modules']}")
+    if args.budget_ms is not None and results['point_query']['wall_ms'] > args.budget_ms:
+        failures.append(f"point query took {results['point_query']['wall_ms']:.0f} ms, budget {args.budget_ms:.0f} ms")
+    if failures:
+        print('Startup regression: ' + '; '.join(failures), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+import sys
+import os
+import argparse
+import datetime as date
+import glob
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+# Add directories to sys.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+from synthetic_archive import make_band_archive, make_ndvi_archive, SYNTHETIC_CRS
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+WORKLOADS = ('point', 'range', 'multipolygon', 'zonal')
+
+#Peak resident memory of this process and its finished children in MB, None where the platform has no getrusage
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / scale
+
+def _files_size(pattern):
+    return sum(os.path.getsize(path) for path in glob.glob(pattern))
+
+#Runs in a fresh process so its peak RSS is the ingest's own
+def ingest_phase(input_dir, output_dir, options):
+    from ndvi_image_functions import run_scene_pool, make_output_profile
+    from raster_catalog import get_catalog_path, query_scenes
+
+    output_profile = make_output_profile(options['format'], options['codec'], options['quality'])
+    started = time.perf_counter()
+    run_scene_pool(input_dir, output_dir, workers=options['workers'], executor=options['executor'], quality=str(options['quality']),
+                   streaming=options['streaming'], output_profile=output_profile, pipeline=options['pipeline'])
+    elapsed = time.perf_counter() - started
+
+    scenes = len(query_scenes(get_catalog_path(output_dir), '0001-01-01', '9999-12-31', [-180, -90, 180, 90]))
+    input_mb = _files_size(os.path.join(input_dir, '*', '*_B[45].TIF')) / 1e6
+    output_mb = _files_size(os.path.join(output_dir, '*', '*.tif')) / 1e6
+    return {'options': options, 'scenes': scenes, 'seconds': elapsed, 'scenes_per_s': scenes / elapsed,
+            'input_mb': input_mb, 'output_mb': output_mb, 'input_mb_per_s': input_mb / elapsed, 'peak_rss_mb': peak_rss_mb()}
+
+def _square(lon, lat, half):
+    return f"(({lon - half} {lat - half}, {lon + half} {lat - half}, {lon + half} {lat + half}, {lon - half} {lat + half}, {lon - half} {lat - half}))"
+
+def _random_location(scenes, rng):
+    min_lon, min_lat, max_lon, max_lat = scenes[rng.integers(len(scenes))]['mbr']
+    return rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)
+
+#Random queries inside random scene footprints: points, squares of range_km, multipolygons of 3 such squares,
+#and for zonal the (lon, lat) centers of `parcels` parcels spread over the whole archive
+def build_workload(scenes, workload, count, range_km, rng, parcels=500):
+    half = range_km / 2 / 111.32
+    queries = []
+    for _ in range(count):
+        lon, lat = _random_location(scenes, rng)
+        if workload == 'zonal':
+            queries.append(np.array([_random_location(scenes, rng) for _ in range(parcels)]))
+        elif workload == 'point':
+            queries.append((lat, lon))
+        elif workload == 'range':
+            queries.append('POLYGON' + _square(lon, lat, half))
+        else:
+            parts = [_square(lon + dx, lat + dy, half) for dx, dy in rng.uniform(-4 * half, 4 * half, (3, 2))]
+            queries.append('MULTIPOLYGON(' + ', '.join(parts) + ')')
+    return queries
+
+def summarize(latencies, rows):
+    ms = np.array(latencies) * 1000
+    return {'queries': len(ms), 'rows': rows, 'first_ms': float(ms[0]), 'mean_ms': float(ms.mean()),
+            'p50_ms': float(np.percentile(ms, 50)), 'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+#GeoPackage of square parcels of edge_km around the given (lon, lat) centers, as a parcel file given to --zones
+def write_parcels(path, centers, edge_km):
+    import geopandas as gpd
+    from shapely.geometry import box
+    half = edge_km / 2 / 111.32
+    parcels = [box(lon - half, lat - half, lon + half, lat + half) for lon, lat in centers]
+    gpd.GeoDataFrame({'parcel': [f'p{i}' for i in range(len(parcels))]}, geometry=parcels, crs='EPSG:4326').to_file(path, driver='GPKG')
+
+#Runs in a fresh process: caches start cold, the first query of each workload is reported separately
+#A zonal query is one run over a file of `parcels` parcels, timed from loading the file like timeseries.py --zones
+def query_phase(archive, workloads, count, range_km, composite, jobs, seed, zonal_count=10, parcels=500, parcel_km=0.5):
+    from time_series_functions import ndvi_timeseries_point, ndvi_timeseries_range, ndvi_zonal_timeseries
+    from raster_catalog import ensure_catalog, query_scenes
+    from wkt_functions import load_zones_file
+
+    scenes = query_scenes(ensure_catalog(archive), '0001-01-01', '9999-12-31', [-180, -90, 180, 90])
+    start_date = date.datetime.strptime(scenes[0]['date'], '%Y-%m-%d')
+    end_date = date.datetime.strptime(scenes[-1]['date'], '%Y-%m-%d')
+    rng = np.random.default_rng(seed)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='ndvi_parcels_') as parcel_dir:
+        for workload in workloads:
+            latencies, rows = [], 0
+            queries = build_workload(scenes, workload, zonal_count if workload == 'zonal' else count, range_km, rng, parcels)
+            for i, query in enumerate(queries):
+                if workload == 'zonal':
+                    query = os.path.join(parcel_dir, f'parcels_{i}.gpkg')
+                    write_parcels(query, queries[i], parcel_km)
+                started = time.perf_counter()
+                if workload == 'point':
+                    df = ndvi_timeseries_point(*query, start_date, end_date, archive, jobs, 'thread', composite)
+                elif workload == 'zonal':
+                    df = ndvi_zonal_timeseries(load_zones_file(query, 'parcel'), start_date, end_date, archive, composite)
+                else:
+                    df = ndvi_timeseries_range(query, start_date, end_date, archive, jobs, 'thread', composite)
+                latencies.append(time.perf_counter() - started)
+                rows += len(df)
+            results[workload] = summarize(latencies, rows)
+            if workload == 'zonal':
+                results[workload]['parcels'] = parcels
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+def run_isolated(func, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+        return pool.submit(func, *args).result()
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#Relative change of the main metrics against an earlier result file, e.g. 0.8 = 20% lower than the baseline
+def compare(results, baseline):
+    changes = {}
+    metrics = [('ingest', 'scenes_per_s'), ('ingest', 'input_mb_per_s'), ('ingest', 'peak_rss_mb'), ('queries', 'peak_rss_mb')]
+    metrics += [('queries', workload, stat) for workload in WORKLOADS for stat in ('p50_ms', 'p99_ms')]
+    for path in metrics:
+        new, old = results, baseline
+        for key in path:
+            new = new.get(key) if isinstance(new, dict) else None
+            old = old.get(key) if isinstance(old, dict) else None
+        if new is not None and old:
+            changes['.'.join(path)] = new / old
+    return {'commit': baseline.get('commit'), 'ratio': changes}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ingest throughput and query latency on a synthetic Landsat-like archive')
+    parser.add_argument('--dates', type=int, default=12, help='Acquisition dates (default: 12)')
+    parser.add_argument('--scenes', type=int, default=4, help='Scenes per date (default: 4)')
+    parser.add_argument('--size', type=int, default=1024, help='Scene edge length in pixels (default: 1024)')
+    parser.add_argument('--crs', type=str, default=SYNTHETIC_CRS, help=f'CRS of the scenes (default: {SYNTHETIC_CRS})')
+    parser.add_argument('--overlap', type=float, default=0.0, help='Share of a scene overlapping its neighbours, 0 to <1 (default: 0)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', type=str, help='Keep the generated archives here instead of a temporary directory')
+    parser.add_argument('--skip-ingest', action='store_true', help='Do not time process_ndvi; write the NDVI archive directly (no GDAL Python bindings needed)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Ingest workers (default: number of CPUs)')
+    parser.add_argument('--executor', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--pipeline', action='store_true', help='Ingest with the staged read/compute/write pipeline')
+    parser.add_argument('--streaming', action='store_true', help='Ingest block by block')
+    parser.add_argument('--format', choices=('gtiff', 'cog'), default='gtiff')
+    parser.add_argument('--codec', choices=('jpeg', 'deflate', 'zstd', 'lzw'), default='jpeg')
+    parser.add_argument('--quality', type=int, default=60)
+    parser.add_argument('--workloads', type=str, default=','.join(WORKLOADS), help=f'Comma-separated query workloads (default: {",".join(WORKLOADS)})')
+    parser.add_argument('--queries', type=int, default=100, help='Queries per workload (default: 100)')
+    parser.add_argument('--range-km', type=float, default=2.0, help='Edge of a range query square in km (default: 2)')
+    parser.add_argument('--zonal-queries', type=int, default=10, help='Zonal runs, each over its own parcel file (default: 10)')
+    parser.add_argument('--parcels', type=int, default=500, help='Parcels per zonal run (default: 500)')
+    parser.add_argument('--parcel-km', type=float, default=0.5, help='Edge of a square parcel in km (default: 0.5)')
+    parser.add_argument('--composite', type=str, default='first_valid', help='Compositing rule of the queries (default: first_valid)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Query jobs (default: 1)')
+    parser.add_argument('--baseline', type=str, help='Earlier result JSON to compare against')
+    parser.add_argument('-o', '--output', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    workloads = [workload for workload in args.workloads.split(',') if workload]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"Unknown workloads {sorted(unknown)}, expected some of {WORKLOADS}")
+    if not 0 <= args.overlap < 1:
+        parser.error('--overlap must be in [0, 1)')
+
+    temp_dir = None
+    workdir = args.workdir
+    if workdir is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix='ndvi_suite_')
+        workdir = temp_dir.name
+    input_dir, archive = os.path.join(workdir, 'bands'), os.path.join(workdir, 'ndvi')
+    layout = {'dates': args.dates, 'scenes': args.scenes, 'size': args.size, 'crs': args.crs, 'overlap': args.overlap, 'seed': args.seed}
+
+    results = {'commit': git_commit(), 'created': date.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+               'archive': layout, 'ingest': None, 'queries': None}
+    try:
+        if args.skip_ingest:
+            make_ndvi_archive(archive, args.dates, args.scenes, args.size, seed=args.seed, crs=args.crs, overlap=args.overlap)
+        else:
+            make_band_archive(input_dir, args.dates, args.scenes, args.size, seed=args.seed, crs=args.crs, overlap=args.overlap)
+            options = {'workers': args.workers, 'executor': args.executor, 'pipeline': args.pipeline, 'streaming': args.streaming,
+                       'format': args.format, 'codec': args.codec, 'quality': args.quality}
+            results['ingest'] = run_isolated(ingest_phase, input_dir, archive, options)
+
+        if workloads:
+            results['queries'] = run_isolated(query_phase, archive, workloads, args.queries, args.range_km, args.composite, args.jobs, args.seed,
+                                              args.zonal_queries, args.parcels, args.parcel_km)
+        if args.baseline:
+            with open(args.baseline) as file:
+                results['baseline'] = compare(results, json.load(file))
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
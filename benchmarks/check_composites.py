@@ -0,0 +1,108 @@
+import sys
+import os
+import argparse
+import tempfile
+
+# Add directories to sys.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+from synthetic_archive import make_ndvi_archive
+from raster_catalog import query_scenes
+from composite_functions import COMPOSITE_RULES
+from log_config import set_console_level
+
+STATISTICS = ['NDVI_MIN', 'NDVI_MAX', 'NDVI_MEDIAN', 'NDVI_MEAN']
+
+#Disjoint random squares on a cells x cells grid over [min_lon, max_lon] x [min_lat, max_lat], written as a GeoJSON of parcels
+def write_parcels(path, bounds, cells, rng):
+    import geopandas as gpd
+    from shapely.geometry import box
+    min_lon, min_lat, max_lon, max_lat = bounds
+    cell_lon, cell_lat = (max_lon - min_lon) / cells, (max_lat - min_lat) / cells
+    parcels = []
+    for i in range(cells):
+        for j in range(cells):
+            left, bottom = min_lon + j * cell_lon, min_lat + i * cell_lat
+            width, height = rng.uniform(0.3, 0.9) * cell_lon, rng.uniform(0.3, 0.9) * cell_lat
+            parcels.append(box(left, bottom, left + width, bottom + height))
+    gpd.GeoDataFrame({'parcel': [f'p{k}' for k in range(len(parcels))]}, geometry=parcels, crs='EPSG:4326').to_file(path, driver='GeoJSON')
+
+#Zonal rows of one parcel against the range series of its polygon: same statistics on the dates the parcel has pixels,
+#no valid pixel (NaN) on every other date
+def compare_parcel(zonal, series, parcel_id, geometry):
+    rows = zonal[zonal['ParcelID'] == parcel_id].set_index('Date')
+    series = series.set_index('Date')
+    failures = []
+    missing = rows.index.difference(series.index)
+    if len(missing):
+        failures.append(f"{parcel_id}: zonal dates {list(missing)} not in the range series")
+    common = rows.index.intersection(series.index)
+    if not np.allclose(rows.loc[common, STATISTICS].to_numpy(float), series.loc[common, STATISTICS].to_numpy(float), equal_nan=True):
+        failures.append(f"{parcel_id}: statistics differ from the range series of {geometry.wkt}")
+    others = series.index.difference(rows.index)
+    if series.loc[others, STATISTICS].notna().any().any():
+        failures.append(f"{parcel_id}: the range series has values on dates the zonal series has no row for")
+    return failures
+
+#Points rows of one point against its point series: same dates, files and values
+def compare_point(points, series, point_id):
+    rows = points[points['PointID'] == point_id].reset_index(drop=True)
+    if len(rows) != len(series) or not (rows['Date'].to_numpy() == series['Date'].to_numpy()).all() or \
+            not (rows['File'].to_numpy() == series['File'].to_numpy()).all() or \
+            not np.allclose(rows['NDVI'].to_numpy(float), series['PixelValue'].to_numpy(float)):
+        return [f"point {point_id}: {len(rows)} rows differ from its point series of {len(series)} rows"]
+    return []
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that the batched points and zonal series composite overlapping scenes like the point and range series')
+    parser.add_argument('--dates', type=int, default=3, help='Acquisition dates (default: 3)')
+    parser.add_argument('--scenes', type=int, default=4, help='Scenes per date (default: 4)')
+    parser.add_argument('--size', type=int, default=256, help='Scene edge length in pixels (default: 256)')
+    parser.add_argument('--overlap', type=float, default=0.3, help='Share of a scene overlapping its neighbours (default: 0.3)')
+    parser.add_argument('--cells', type=int, default=5, help='Parcels per side of the parcel grid (default: 5)')
+    parser.add_argument('--points', type=int, default=40, help='Random points (default: 40)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    set_console_level(quiet=True)
+
+    from wkt_functions import load_zones_file
+    import pandas as pd
+    from time_series_functions import ndvi_zonal_timeseries, ndvi_timeseries_range, ndvi_timeseries_points, ndvi_timeseries_point
+
+    rng = np.random.default_rng(args.seed)
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='ndvi_composites_') as workdir:
+        archive = os.path.join(workdir, 'ndvi')
+        catalog_path = make_ndvi_archive(archive, dates=args.dates, scenes=args.scenes, size=args.size, seed=args.seed, overlap=args.overlap)
+        scenes = query_scenes(catalog_path, '0001-01-01', '9999-12-31', [-180, -90, 180, 90])
+        mbrs = np.array([scene['mbr'] for scene in scenes])
+        bounds = [mbrs[:, 0].min(), mbrs[:, 1].min(), mbrs[:, 2].max(), mbrs[:, 3].max()]
+        zones_path = os.path.join(workdir, 'parcels.geojson')
+        write_parcels(zones_path, bounds, args.cells, rng)
+        zones_gdf = load_zones_file(zones_path, 'parcel')
+        points_df = pd.DataFrame({'PointID': range(args.points), 'Latitude': rng.uniform(bounds[1], bounds[3], args.points),
+                                  'Longitude': rng.uniform(bounds[0], bounds[2], args.points)})
+
+        for rule in COMPOSITE_RULES:
+            zonal = ndvi_zonal_timeseries(zones_gdf, '0001-01-01', '9999-12-31', archive, composite=rule)
+            for parcel_id, geometry in zip(zones_gdf['ParcelID'], zones_gdf.geometry):
+                series = ndvi_timeseries_range(geometry.wkt, '0001-01-01', '9999-12-31', archive, composite=rule)
+                single = ndvi_zonal_timeseries(zones_gdf[zones_gdf['ParcelID'] == parcel_id], '0001-01-01', '9999-12-31', archive, composite=rule)
+                failures += [f"{rule}: {failure}" for failure in compare_parcel(zonal, series, parcel_id, geometry)]
+                failures += [f"{rule} (single parcel): {failure}" for failure in compare_parcel(single, series, parcel_id, geometry)]
+            print(f"{rule}: {len(zones_gdf)} parcels, {len(zonal)} zonal rows, {int(zonal['PixelCount'].sum())} pixels")
+
+            points = ndvi_timeseries_points(points_df, '0001-01-01', '9999-12-31', archive, composite=rule)
+            for point_id, latitude, longitude in points_df.itertuples(index=False):
+                series = ndvi_timeseries_point(latitude, longitude, '0001-01-01', '9999-12-31', archive, composite=rule)
+                failures += [f"{rule}: {failure}" for failure in compare_point(points, series, point_id)]
+            print(f"{rule}: {len(points_df)} points, {len(points)} points rows")
+
+    if failures:
+        print('\n'.join(failures), file=sys.stderr)
+        sys.exit(1)
+    print('Points and zonal series match the point and range series')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import sys
+import os
+import time
+import argparse
+import tempfile
+
+# Add directories to sys.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from raster_cache import RasterCache
+
+#Constant-valued tiled GeoTIFF, written to a temporary name and renamed over path like the ingest does
+def write_constant(path, value, size, block):
+    profile = dict(driver='GTiff', width=size, height=size, count=1, dtype='uint8', crs='EPSG:4326',
+                   transform=from_origin(0, size, 1, 1), tiled=True, blockxsize=block, blockysize=block)
+    tmp_path = path + '.tmp'
+    with rio.open(tmp_path, 'w', **profile) as dst:
+        dst.write(np.full((size, size), value, dtype=np.uint8), 1)
+    os.replace(tmp_path, path)
+
+def read_value(cache, path, size):
+    return int(cache.read_window(path, Window(0, 0, size, size)).max())
+
+#Each case rewrites a.tif after its blocks were cached and expects the next read to see the new value
+def main():
+    parser = argparse.ArgumentParser(description='Check that the raster cache never serves blocks of a rewritten file')
+    parser.add_argument('--size', type=int, default=64, help='Raster edge length in pixels (default: 64)')
+    parser.add_argument('--block', type=int, default=16, help='Internal block edge length in pixels (default: 16)')
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='ndvi_raster_cache_') as workdir:
+        path_a, path_b = os.path.join(workdir, 'a.tif'), os.path.join(workdir, 'b.tif')
+        for case, max_open in [('cached handle', 2), ('evicted handle', 1)]:
+            cache = RasterCache(max_open=max_open)
+            write_constant(path_a, 10, args.size, args.block)
+            write_constant(path_b, 20, args.size, args.block)
+            before = read_value(cache, path_a, args.size)
+            read_value(cache, path_b, args.size)
+            # The rewrite must be visible even on filesystems with a coarse modification time
+            time.sleep(0.01)
+            write_constant(path_a, 99, args.size, args.block)
+            after = read_value(cache, path_a, args.size)
+            stats = cache.stats()
+            print(f"{case}: read {before} then {after} after the rewrite, {stats['handle_evictions']} handle evictions")
+            if (before, after) != (10, 99):
+                failures.append(f"{case}: expected 10 then 99, read {before} then {after}")
+            cache.clear()
+
+    if failures:
+        print('\n'.join(failures), file=sys.stderr)
+        sys.exit(1)
+    print('Rewritten files are read back fresh')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import sys
+import os
+import argparse
+import datetime as date
+
+# Add directories to sys.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+import rasterio as rio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from bounding_box_functions import get_raster_metadata
+from crs_functions import transform_xy
+from raster_catalog import get_catalog_path, add_scene_to_catalog
+
+# Scenes of one date are laid out on a grid_cols-wide grid of tiles, by default in UTM zone 11N
+SYNTHETIC_CRS = 'EPSG:32611'
+SYNTHETIC_ORIGIN = (500000.0, 4000000.0)
+# Top-left corner of the layout in lon/lat, used to place it in any other CRS
+SYNTHETIC_ORIGIN_LONLAT = (-117.0, 36.1447)
+PIXEL_SIZE = 30.0
+
+#Smooth field of NDVI codes (1..255) that drifts with the season, plus a nodata border like a Landsat path edge
+def synthetic_ndvi_scene(size, day_of_year, row, col, rng):
+    return ndvi_to_codes(synthetic_ndvi_field(size, day_of_year, row, col, rng))
+
+def synthetic_ndvi_field(size, day_of_year, row, col, rng):
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    season = np.sin(2 * np.pi * day_of_year / 365.0)
+    ndvi = 0.3 + 0.3 * season + 0.2 * np.sin(6 * x + row) * np.cos(5 * y + col)
+    ndvi += rng.normal(0, 0.03, ndvi.shape).astype(np.float32)
+    return ndvi
+
+def ndvi_to_codes(ndvi):
+    size = ndvi.shape[1]
+    codes = np.clip(np.rint(128 + 127 * np.clip(ndvi, -1, 1)), 1, 255).astype(np.uint8)
+    codes[:, :max(1, size // 50)] = 0
+    return codes
+
+#Landsat-like uint16 B4 (red) and B5 (NIR) digital numbers (reflectance x 10000) whose NDVI is the same field,
+#0 in both bands on the nodata border
+def synthetic_band_scene(size, day_of_year, row, col, rng):
+    ndvi = np.clip(synthetic_ndvi_field(size, day_of_year, row, col, rng), -0.95, 0.95)
+    red = rng.uniform(0.03, 0.15, ndvi.shape).astype(np.float32)
+    nir = red * (1 + ndvi) / (1 - ndvi)
+    red_dn = np.clip(np.rint(red * 10000), 1, 65535).astype(np.uint16)
+    nir_dn = np.clip(np.rint(nir * 10000), 1, 65535).astype(np.uint16)
+    border = max(1, size // 50)
+    red_dn[:, :border] = 0
+    nir_dn[:, :border] = 0
+    return red_dn, nir_dn
+
+#Upper-left corner and pixel size of the layout in crs; a geographic CRS gets about 30 m pixels in degrees
+def layout_origin(crs=SYNTHETIC_CRS):
+    crs = CRS.from_user_input(crs)
+    if crs == CRS.from_user_input(SYNTHETIC_CRS):
+        return SYNTHETIC_ORIGIN, PIXEL_SIZE
+    x, y = transform_xy(*SYNTHETIC_ORIGIN_LONLAT, 'EPSG:4326', crs)
+    return (float(x), float(y)), (PIXEL_SIZE / 111320.0 if crs.is_geographic else PIXEL_SIZE)
+
+#Transform of scene s of a date; neighbouring scenes share `overlap` (0..1) of their width/height like adjacent paths
+def scene_transform(s, scenes, size, crs=SYNTHETIC_CRS, overlap=0.0):
+    grid_cols = int(np.ceil(np.sqrt(scenes)))
+    row, col = divmod(s, grid_cols)
+    (origin_x, origin_y), pixel_size = layout_origin(crs)
+    step = size * (1 - overlap) * pixel_size
+    return row, col, from_origin(origin_x + col * step, origin_y - row * step, pixel_size, pixel_size)
+
+def _archive_days(dates, start, step_days):
+    first_day = date.datetime.strptime(start, '%Y-%m-%d')
+    return [first_day + date.timedelta(days=d * step_days) for d in range(dates)]
+
+#Writes dates x scenes NDVI images in the processed-archive layout (one YYYY-MM-DD folder per date) and catalogs them
+def make_ndvi_archive(root, dates=12, scenes=4, size=512, start='2020-01-01', step_days=16, tiled=False, seed=0,
+                      crs=SYNTHETIC_CRS, overlap=0.0):
+    rng = np.random.default_rng(seed)
+    catalog_path = get_catalog_path(root)
+    profile = dict(driver='GTiff', width=size, height=size, count=1, dtype='uint8', crs=crs, nodata=0)
+    if tiled:
+        profile.update(tiled=True, blockxsize=512, blockysize=512, compress='deflate', predictor=2)
+    else:
+        profile.update(compress='jpeg', jpeg_quality=60)
+
+    for curr_day in _archive_days(dates, start, step_days):
+        dir = curr_day.strftime('%Y-%m-%d')
+        os.makedirs(os.path.join(root, dir), exist_ok=True)
+        for s in range(scenes):
+            row, col, transform = scene_transform(s, scenes, size, crs, overlap)
+            raster_path = os.path.join(root, dir, f'SYN_{row:02d}{col:02d}_{dir.replace("-", "")}_NDVI.tif')
+            with rio.open(raster_path, 'w', transform=transform, **profile) as dataset:
+                dataset.write(synthetic_ndvi_scene(size, curr_day.timetuple().tm_yday, row, col, rng), 1)
+            add_scene_to_catalog(catalog_path, dir, raster_path, **get_raster_metadata(raster_path))
+    return catalog_path
+
+#Writes dates x scenes B4/B5 pairs in the raw input layout process_ndvi.py reads (YYYY-MM-DD folders of *_B4.TIF/*_B5.TIF),
+#as tiled DEFLATE GeoTIFFs like Landsat Collection 2; returns the number of scenes written
+def make_band_archive(root, dates=12, scenes=4, size=512, start='2020-01-01', step_days=16, seed=0,
+                      crs=SYNTHETIC_CRS, overlap=0.0):
+    rng = np.random.default_rng(seed)
+    profile = dict(driver='GTiff', width=size, height=size, count=1, dtype='uint16', crs=crs, nodata=0,
+                   tiled=True, blockxsize=256, blockysize=256, compress='deflate', predictor=2)
+
+    for curr_day in _archive_days(dates, start, step_days):
+        dir = curr_day.strftime('%Y-%m-%d')
+        os.makedirs(os.path.join(root, dir), exist_ok=True)
+        for s in range(scenes):
+            row, col, transform = scene_transform(s, scenes, size, crs, overlap)
+            base_name = os.path.join(root, dir, f'LC08_SYN_{row:03d}{col:03d}_{dir.replace("-", "")}')
+            for band, data in zip(('B4', 'B5'), synthetic_band_scene(size, curr_day.timetuple().tm_yday, row, col, rng)):
+                with rio.open(f'{base_name}_{band}.TIF', 'w', transform=transform, **profile) as dataset:
+                    dataset.write(data, 1)
+    return dates * scenes
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic processed NDVI archive with its catalog, or raw B4/B5 inputs')
+    parser.add_argument('-o', '--output', metavar='output_directory', type=str, required=True, help='Directory to write the archive to')
+    parser.add_argument('--bands', action='store_true', help='Write raw B4/B5 input scenes for process_ndvi.py instead of NDVI images')
+    parser.add_argument('--dates', type=int, default=12, help='Number of acquisition dates (default: 12)')
+    parser.add_argument('--scenes', type=int, default=4, help='Scenes per date (default: 4)')
+    parser.add_argument('--size', type=int, default=512, help='Scene edge length in pixels (default: 512)')
+    parser.add_argument('--crs', type=str, default=SYNTHETIC_CRS, help=f'CRS of the scenes (default: {SYNTHETIC_CRS})')
+    parser.add_argument('--overlap', type=float, default=0.0, help='Share of a scene overlapping its neighbours, 0 to <1 (default: 0)')
+    parser.add_argument('--tiled', action='store_true', help='Write tiled DEFLATE images instead of striped JPEG')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if not 0 <= args.overlap < 1:
+        parser.error('--overlap must be in [0, 1)')
+
+    if args.bands:
+        make_band_archive(args.output, args.dates, args.scenes, args.size, seed=args.seed, crs=args.crs, overlap=args.overlap)
+        print(args.output)
+    else:
+        catalog_path = make_ndvi_archive(args.output, args.dates, args.scenes, args.size, tiled=args.tiled, seed=args.seed,
+                                         crs=args.crs, overlap=args.overlap)
+        print(catalog_path)
+
+if __name__ == '__main__':
+    main()
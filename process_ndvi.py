@@ -1,38 +1,61 @@
 import sys
 import os
 import argparse
-import logging
 
 # Add directories to sys.path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
 # Import functions
 from ndvi_image_functions import *
-from log_config import logger, console_handler
+from parallel_functions import EXECUTORS
+from ndvi_cube import build_ndvi_cubes, DEFAULT_CUBE_TILE
+from metrics import report_metrics, profiled, METRICS_FORMATS, PROFILERS
+from log_config import set_console_level
 
 def main():
     parser = argparse.ArgumentParser(description='Convert satellite images to NDVI')
     parser.add_argument('-i', '--input', metavar='input_directory', type=str, required=True, help='Enter input directory of dataset')
     parser.add_argument('-o', '--output', metavar='output_directory', type=str, required=True, help='Enter output directory for NDVI images')
+    parser.add_argument('-w', '--workers', metavar='workers', type=int, default=os.cpu_count(), help='Number of parallel workers (default: number of CPUs)')
+    parser.add_argument('--executor', choices=EXECUTORS, default='thread', help='Run scenes on a thread or process pool (default: thread)')
+    parser.add_argument('--max-in-flight', metavar='tasks', type=int, help='Maximum scenes submitted at once (default: 2 x workers)')
+    parser.add_argument('--streaming', action='store_true', help='Compute NDVI block by block to bound memory per worker')
+    parser.add_argument('--pipeline', action='store_true', help='Run reading, NDVI computation (--workers threads) and writing as separate stages joined by bounded queues')
+    parser.add_argument('--readers', metavar='threads', type=int, default=1, help='With --pipeline, threads reading input bands (default: 1)')
+    parser.add_argument('--writers', metavar='threads', type=int, default=1, help='With --pipeline, threads encoding and writing outputs (default: 1)')
+    parser.add_argument('--queue-size', metavar='scenes', type=int, default=2, help='With --pipeline, scenes waiting between two stages (default: 2)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='gtiff', help='Output layout: striped GeoTIFF or tiled Cloud-Optimized GeoTIFF with overviews (default: gtiff)')
+    parser.add_argument('--codec', choices=OUTPUT_CODECS, default='jpeg', help='Output compression; deflate, zstd and lzw are lossless (default: jpeg)')
+    parser.add_argument('--quality', metavar='quality', type=int, default=60, help='JPEG quality 1-100 (default: 60)')
+    parser.add_argument('--incremental', action='store_true', help='Only process scenes that are new, changed or incomplete according to the manifest')
+    parser.add_argument('--verify', action='store_true', help='With --incremental, list every folder and re-check output checksums')
+    parser.add_argument('--build-cube', action='store_true', help='After processing, build or refresh the time-major NDVI cube of every grid for fast queries')
+    parser.add_argument('--cube-tile', metavar='pixels', type=int, default=DEFAULT_CUBE_TILE, help=f'Edge of the spatial tile of a cube chunk (default: {DEFAULT_CUBE_TILE})')
+    parser.add_argument('--metrics', metavar='path', type=str, help='Write stage timings and counters of the run to this file')
+    parser.add_argument('--metrics-format', choices=METRICS_FORMATS, default='json', help='json (overwrite), jsonl (append one line per run) or prom (Prometheus textfile) (default: json)')
+    parser.add_argument('--profile', choices=PROFILERS, help='Run under cProfile or tracemalloc and log the top entries')
+    parser.add_argument('--profile-out', metavar='path', type=str, help='With --profile, write the full profile (pstats file or allocation report) here')
     parser.add_argument('-q', '--quiet', action='store_true', help='Turns off Messages until WARNING LEVEL')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Also log every file created or skipped')
 
     args = parser.parse_args()
+    if args.pipeline and (args.streaming or args.executor != 'thread'):
+        parser.error('--pipeline cannot be combined with --streaming or --executor process')
 
     input_directory = args.input
     output_directory = args.output
-    quiet = args.quiet
-
-    if quiet:
-        console_handler.setLevel(logging.ERROR)
-    else:
-        console_handler.setLevel(logging.DEBUG)
-    
-    logger.addHandler(console_handler)
-
-    cpu_count = os.cpu_count()
-    dir_queue = initialize_queue(input_directory)
-    threads = create_and_start_threads(input_directory, output_directory, dir_queue, num_threads=cpu_count, quality='60')
-    wait_for_threads_to_complete(threads)
+    set_console_level(args.quiet, args.verbose)
+
+    quality = str(args.quality)
+    output_profile = make_output_profile(args.format, args.codec, quality)
+    with profiled(args.profile, args.profile_out):
+        run_scene_pool(input_directory, output_directory, workers=args.workers, executor=args.executor, quality=quality, max_in_flight=args.max_in_flight, streaming=args.streaming, output_profile=output_profile, incremental=args.incremental, verify=args.verify,
+                       pipeline=args.pipeline, readers=args.readers, writers=args.writers, queue_size=args.queue_size)
+
+        if args.build_cube:
+            build_ndvi_cubes(output_directory, tile=args.cube_tile, workers=args.workers)
+
+    report_metrics('process_ndvi', args.metrics, args.metrics_format)
 
 if __name__ == '__main__':
     main()
@@ -1,39 +1,60 @@
 import rasterio as rio
-from wkt_functions import *
+import rasterio.transform
+import numpy as np
+from rasterio.crs import CRS
+from affine import Affine
+from wkt_functions import wkt_to_bounds, bounds_to_wkt
+from crs_functions import transform_xy, transform_bounds
 #Returns bounding box in this order: min_lon, min_lat, max_lon, max_lat
 def get_boundingbox(raster_path, user_crs = 'EPSG:4326'):   
     with rio.open(raster_path) as dataset:
         bounds = dataset.bounds
         crs = dataset.crs
     
-    transformer = Transformer.from_crs(crs, user_crs, always_xy=True)
-    
-    # Convert the bounds
-    min_lon, min_lat = transformer.transform(bounds.left, bounds.bottom)
-    max_lon, max_lat = transformer.transform(bounds.right, bounds.top)
+    # Edges are densified, a projected rectangle is not a rectangle in lon/lat
+    min_lon, min_lat, max_lon, max_lat = transform_bounds(*bounds, src_crs=crs, dst_crs=user_crs)
     
     return bounds_to_wkt(min_lon, min_lat, max_lon, max_lat)
 
+#Returns the metadata stored in the raster catalog, mbr in the same order as get_boundingbox
+def get_raster_metadata(raster_path, user_crs = 'EPSG:4326'):
+    with rio.open(raster_path) as dataset:
+        return get_grid_metadata(dataset.transform.to_gdal(), dataset.crs, dataset.width, dataset.height, user_crs)
+
+#Same metadata from a GDAL geotransform and projection already in memory, without opening the raster
+def get_grid_metadata(geotransform, projection, width, height, user_crs = 'EPSG:4326'):
+    crs = CRS.from_user_input(projection)
+    bounds = rio.transform.array_bounds(height, width, Affine.from_gdal(*geotransform))
+
+    min_lon, min_lat, max_lon, max_lat = transform_bounds(*bounds, src_crs=crs, dst_crs=user_crs)
+
+    return {
+        'crs': crs.to_string(),
+        'geotransform': tuple(geotransform),
+        'width': width,
+        'height': height,
+        'mbr': [min_lon, min_lat, max_lon, max_lat],
+    }
+
 
 def transform_coordinates(lat, lon, src_crs='EPSG:4326', dst_crs='EPSG:4326'):
-    transformer = rio.from_crs(src_crs, dst_crs, always_xy=True)
-    x, y = transformer.transform(lon, lat)  
+    x, y = transform_xy(lon, lat, src_crs, dst_crs)
     return x, y
 
 #Helper Functions: Assuming Bounding box information has been given
-#takes mbr as: [min_lon, min_lat, max_lon, max_lat]
+#takes mbr as: [min_lon, min_lat, max_lon, max_lat] or an (n, 4) array of them
+#Coordinates may be scalars or NumPy arrays, the result broadcasts like NumPy (e.g. lat[:, None] against n mbrs)
 def inBoundingBox_point(point_latitude, point_longitude, mbr=[0, 0, 0, 0], crs='EPSG:4326', target_crs='EPSG:4326'):
-    min_lon, min_lat, max_lon, max_lat = mbr
-    if crs != target_crs:
-        point_lon, point_lat = transform_coordinates(point_latitude, point_longitude, src_crs=crs, dst_crs=target_crs)
-    else:
-        point_lon, point_lat = point_longitude, point_latitude
-    return (min_lat <= point_lat <= max_lat and min_lon <= point_lon <= max_lon)
+    mbr = np.asarray(mbr, dtype=float)
+    min_lon, min_lat, max_lon, max_lat = mbr[..., 0], mbr[..., 1], mbr[..., 2], mbr[..., 3]
+    point_lon, point_lat = transform_coordinates(np.asarray(point_latitude, dtype=float), np.asarray(point_longitude, dtype=float),
+                                                 src_crs=crs, dst_crs=target_crs)
+    inside = (min_lat <= point_lat) & (point_lat <= max_lat) & (min_lon <= point_lon) & (point_lon <= max_lon)
+    return inside if np.ndim(inside) else bool(inside)
 
 def inBoundingBox_range(wkt_string='', mbr=[0, 0, 0, 0], crs='EPSG:4326', target_crs='EPSG:4326'):
-    min_lon, min_lat, max_lon, max_lat = mbr
-    wkt_min_lon, wkt_min_lat, wkt_max_lon, wkt_max_lat = wkt_to_bounds(wkt_string)
-    if crs != target_crs:
-        wkt_min_lon, wkt_min_lat = transform_coordinates(wkt_min_lat, wkt_min_lon, src_crs=crs, dst_crs=target_crs)
-        wkt_max_lon, wkt_max_lat = transform_coordinates(wkt_max_lat, wkt_max_lon, src_crs=crs, dst_crs=target_crs)
-    return (min_lon <= wkt_max_lon and wkt_min_lon <= max_lon and min_lat <= wkt_max_lat and wkt_min_lat <= max_lat)
\ No newline at end of file
+    mbr = np.asarray(mbr, dtype=float)
+    min_lon, min_lat, max_lon, max_lat = mbr[..., 0], mbr[..., 1], mbr[..., 2], mbr[..., 3]
+    wkt_min_lon, wkt_min_lat, wkt_max_lon, wkt_max_lat = wkt_to_bounds(wkt_string, src_crs=crs, dst_crs=target_crs)
+    overlaps = (min_lon <= wkt_max_lon) & (wkt_min_lon <= max_lon) & (min_lat <= wkt_max_lat) & (wkt_min_lat <= max_lat)
+    return overlaps if np.ndim(overlaps) else bool(overlaps)
\ No newline at end of file
@@ -0,0 +1,311 @@
+import threading as th
+from types import SimpleNamespace
+import numpy as np
+import rasterio as rio
+import rasterio.transform
+import rasterio.windows
+import rasterio.warp
+import rasterio.features
+from rasterio.crs import CRS
+from affine import Affine
+from raster_cache import raster_cache
+from crs_functions import transform_xy, transform_bounds
+from ndvi_cube import read_cube_window, preload_cube_windows
+from ndvi_extraction_functions import get_aoi_window_and_mask
+from log_config import logger
+
+#How overlapping scenes of one date are merged into one value per location:
+#first_valid takes the first scene in catalog order with a valid pixel, max_ndvi the highest valid value,
+#least_nodata the first valid pixel after ordering the scenes by their number of valid pixels (most first)
+COMPOSITE_RULES = ('first_valid', 'max_ndvi', 'least_nodata')
+# Zone label images are composited in strips of this many rows, so the per-pixel index arrays stay small
+_ZONE_STRIP_ROWS = 512
+_MAX_CACHED_LABEL_IMAGES = 16
+# Points are read in windows of at most this many pixels a side, each holding the points of one cell of that size
+_POINT_CELL = 256
+
+_grids = {}
+_grids_lock = th.Lock()
+
+#Grid of a catalog scene (CRS, transform, shape) from its catalog row, without opening the file
+def scene_grid(scene):
+    key = (scene['crs'], tuple(scene['geotransform']), scene['width'], scene['height'])
+    with _grids_lock:
+        grid = _grids.get(key)
+    if grid is None:
+        grid = SimpleNamespace(crs=CRS.from_user_input(scene['crs']), transform=Affine.from_gdal(*scene['geotransform']),
+                               width=scene['width'], height=scene['height'], shape=(scene['height'], scene['width']))
+        with _grids_lock:
+            _grids[key] = grid
+    return grid
+
+#Scenes grouped by date, in catalog order
+def group_scenes_by_date(scenes):
+    groups = []
+    for scene in scenes:
+        if groups and groups[-1][0]['date'] == scene['date']:
+            groups[-1].append(scene)
+        else:
+            groups.append([scene])
+    return groups
+
+def order_scenes(scenes, rule='first_valid'):
+    if rule not in COMPOSITE_RULES:
+        raise ValueError(f"Unknown compositing rule {rule}, expected one of {COMPOSITE_RULES}")
+    if rule == 'least_nodata':
+        # Scenes cataloged without a valid pixel count go last, in catalog order
+        return sorted(scenes, key=lambda s: -s['valid_pixels'] if s.get('valid_pixels') is not None else 1)
+    return list(scenes)
+
+#Window of a scene, from its cube when attach_cubes found a current one
+#(from the history preloaded by preload_point_history or preload_range_history when it holds the window)
+def read_scene_window(scene, window):
+    if scene.get('cube_window') is not None:
+        loaded, data = scene['cube_window']
+        row_off, col_off = int(window.row_off) - int(loaded.row_off), int(window.col_off) - int(loaded.col_off)
+        if row_off >= 0 and col_off >= 0 and row_off + int(window.height) <= int(loaded.height) and \
+                col_off + int(window.width) <= int(loaded.width):
+            return data[row_off:row_off + int(window.height), col_off:col_off + int(window.width)]
+    if scene.get('cube') is not None:
+        return read_cube_window(*scene['cube'], window)
+    return raster_cache.read_window(scene['path'], window)
+
+#Before a point series: the history of the pixel at (latitude, longitude) in every cube, one read per cube
+def preload_point_history(scenes, latitude, longitude):
+    def window_of(scene):
+        grid = scene_grid(scene)
+        xs, ys = transform_xy(np.array([longitude]), np.array([latitude]), 'EPSG:4326', grid.crs)
+        cols, rows = ~grid.transform * (np.asarray(xs), np.asarray(ys))
+        row, col = int(np.floor(rows[0])), int(np.floor(cols[0]))
+        if not (0 <= row < grid.height and 0 <= col < grid.width):
+            return None
+        return rio.windows.Window(col, row, 1, 1)
+    preload_cube_windows(scenes, window_of)
+
+#Before a range series: the history of the AOI's bounding window in every cube, one read per cube
+def preload_range_history(scenes, wkt_string, crs='EPSG:4326'):
+    def window_of(scene):
+        grid = scene_grid(scene)
+        window, _ = get_aoi_window_and_mask(wkt_string, grid, crs)
+        if window is None:
+            return None
+        # Scenes sampled at another scene's pixel centers can land one pixel outside the AOI's box on their grid
+        row_start, col_start = max(int(window.row_off) - 1, 0), max(int(window.col_off) - 1, 0)
+        row_stop = min(int(window.row_off) + int(window.height) + 1, grid.height)
+        col_stop = min(int(window.col_off) + int(window.width) + 1, grid.width)
+        return rio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    preload_cube_windows(scenes, window_of)
+
+#Values of scene at the given pixels, grouped by cell so each window is read once; every pixel must lie inside the scene
+def _read_scene_pixels(scene, rows, cols):
+    values = np.zeros(rows.shape, dtype=np.uint8)
+    grid = scene_grid(scene)
+    cell_ids = (rows // _POINT_CELL) * (grid.width // _POINT_CELL + 1) + cols // _POINT_CELL
+    order = np.argsort(cell_ids, kind='stable')
+    splits = np.nonzero(np.diff(cell_ids[order]))[0] + 1
+    for group in np.split(order, splits):
+        row_off, col_off = rows[group].min(), cols[group].min()
+        window = rio.windows.Window(col_off, row_off, cols[group].max() - col_off + 1, rows[group].max() - row_off + 1)
+        data = read_scene_window(scene, window)
+        if data.dtype != np.uint8:
+            raise ValueError(f"{scene['path']} is not a uint8 NDVI image")
+        values[group] = data[rows[group] - row_off, cols[group] - col_off]
+    return values
+
+#Composited pixel values of one date at many (latitude, longitude) points: values (0 where no scene has one), the index of the
+#scene each value came from in the ordered scenes (-1 for none) and the ordered scenes
+#Once every point has a value the remaining scenes are skipped without being read (except with max_ndvi)
+def composite_point_values(scenes, latitudes, longitudes, rule='first_valid'):
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    scenes = order_scenes(scenes, rule)
+    values = np.zeros(latitudes.shape, dtype=np.uint8)
+    sources = np.full(latitudes.shape, -1, dtype=np.int64)
+    for s, scene in enumerate(scenes):
+        # max_ndvi has to see every scene, the other rules only need the points that are still empty
+        pending = np.arange(values.size) if rule == 'max_ndvi' else np.nonzero(values == 0)[0]
+        if pending.size == 0:
+            break
+        grid = scene_grid(scene)
+        xs, ys = transform_xy(longitudes[pending], latitudes[pending], 'EPSG:4326', grid.crs)
+        cols, rows = ~grid.transform * (np.asarray(xs), np.asarray(ys))
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+        inside = (rows >= 0) & (rows < grid.height) & (cols >= 0) & (cols < grid.width)
+        if not inside.any():
+            continue
+        pending, rows, cols = pending[inside], rows[inside], cols[inside]
+        try:
+            scene_values = _read_scene_pixels(scene, rows, cols)
+        except Exception as e:
+            logger.warning(f"Error processing image {scene['path']}: {e}")
+            continue
+        # Ties under max_ndvi keep the earlier scene
+        better = scene_values > values[pending]
+        values[pending[better]] = scene_values[better]
+        sources[pending[better]] = s
+    return values, sources, scenes
+
+#Composited pixel value of one date at (latitude, longitude) and the scene it came from, (None, None) if no scene has one
+def composite_point_value(scenes, latitude, longitude, rule='first_valid'):
+    values, sources, scenes = composite_point_values(scenes, [latitude], [longitude], rule)
+    if sources[0] < 0:
+        return None, None
+    return values[0], scenes[sources[0]]
+
+#Values of scene at the centers of the given pixels of another grid, 0 where the scene has no pixel
+#Only the bounding window of the pixels that fall inside the scene is read
+def _sample_scene(scene, ref_grid, rows, cols):
+    grid = scene_grid(scene)
+    xs, ys = ref_grid.transform * (cols + 0.5, rows + 0.5)
+    xs, ys = transform_xy(xs, ys, ref_grid.crs, grid.crs)
+    scene_cols, scene_rows = ~grid.transform * (np.asarray(xs), np.asarray(ys))
+    scene_rows = np.floor(scene_rows).astype(np.int64)
+    scene_cols = np.floor(scene_cols).astype(np.int64)
+    inside = (scene_rows >= 0) & (scene_rows < grid.height) & (scene_cols >= 0) & (scene_cols < grid.width)
+
+    values = np.zeros(rows.shape, dtype=np.uint8)
+    if not inside.any():
+        return values, False
+    scene_rows, scene_cols = scene_rows[inside], scene_cols[inside]
+    row_off, col_off = scene_rows.min(), scene_cols.min()
+    window = rio.windows.Window(col_off, row_off, scene_cols.max() - col_off + 1, scene_rows.max() - row_off + 1)
+    data = read_scene_window(scene, window)
+    if data.dtype != np.uint8:
+        raise ValueError(f"{scene['path']} is not a uint8 NDVI image")
+    values[inside] = data[scene_rows - row_off, scene_cols - col_off]
+    return values, True
+
+#Composite of the ordered scenes at the given pixels of ref_grid, 0 where no scene has a valid value
+#Once every pixel has a value the remaining scenes are skipped without being read (except with max_ndvi)
+def _composite_pixels(scenes, ref_grid, rows, cols, rule):
+    composite = np.zeros(rows.shape, dtype=np.uint8)
+    skipped = 0
+    for scene in scenes:
+        # max_ndvi has to see every scene, the other rules only need the pixels that are still empty
+        pending = np.arange(rows.size) if rule == 'max_ndvi' else np.nonzero(composite == 0)[0]
+        if pending.size == 0:
+            skipped += 1
+            continue
+        try:
+            values, touched = _sample_scene(scene, ref_grid, rows[pending], cols[pending])
+        except Exception as e:
+            logger.warning(f"Error processing image {scene['path']}: {e}")
+            continue
+        if not touched:
+            skipped += 1
+        elif rule == 'max_ndvi':
+            np.maximum(composite, values, out=composite)
+        else:
+            composite[pending] = values
+
+    if skipped:
+        logger.debug(f"Date {scenes[0]['date']}: {skipped} of {len(scenes)} scenes skipped, the area was already covered")
+    return composite
+
+#256-bin histogram of one date's composite over the AOI, every AOI pixel counted once
+#The composite lives on the grid of the first scene; the other scenes are sampled at its pixel centers
+def composite_range_histogram(scenes, wkt_string, rule='first_valid', crs='EPSG:4326'):
+    scenes = order_scenes(scenes, rule)
+    ref_grid = scene_grid(scenes[0])
+    window, mask = get_aoi_window_and_mask(wkt_string, ref_grid, crs, clip=False)
+    histogram = np.zeros(256, dtype=np.int64)
+    if window is None:
+        return histogram
+
+    rows, cols = np.nonzero(mask)
+    rows, cols = rows + int(window.row_off), cols + int(window.col_off)
+    composite = _composite_pixels(scenes, ref_grid, rows, cols, rule)
+    histogram += np.bincount(composite, minlength=256)
+    histogram[0] = 0
+    return histogram
+
+#Zones at zone_indices rasterized on grid: window and label image (zone k of zone_indices is label k + 1, 0 is background,
+#overlapping zones keep the last label), (None, None) if none of them covers a pixel of the window
+#The window is the zones' bounding box on the grid, clipped to the extent of the scenes
+#Zones are reprojected like get_aoi_window_and_mask does, so a single zone covers the same pixels as that AOI in a range query
+def _zone_labels(zones_gdf, zone_indices, grid, scenes, cache):
+    crs_key = grid.crs.to_string()
+    if ('zones', crs_key) not in cache:
+        from shapely.geometry import mapping
+        cache[('zones', crs_key)] = rio.warp.transform_geom(zones_gdf.crs, grid.crs, [mapping(g) for g in zones_gdf.geometry])
+    geometries = [cache[('zones', crs_key)][k] for k in zone_indices]
+
+    # Dates with the same scene grids share their label images
+    grid_keys = tuple((s['crs'], tuple(s['geotransform']), s['width'], s['height']) for s in scenes)
+    label_key = ('labels', grid_keys, zone_indices.tobytes())
+    if label_key in cache:
+        return cache[label_key]
+
+    bounds = np.array([rio.features.bounds(g) for g in geometries])
+    min_x, min_y, max_x, max_y = bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+    cols, rows = ~grid.transform * (np.array([min_x, max_x, min_x, max_x]), np.array([min_y, min_y, max_y, max_y]))
+    row_start, row_stop = int(np.floor(rows.min())), int(np.ceil(rows.max()))
+    col_start, col_stop = int(np.floor(cols.min())), int(np.ceil(cols.max()))
+
+    # Pixels outside every scene can never get a value
+    extent = []
+    for scene in scenes:
+        other = scene_grid(scene)
+        left, bottom, right, top = rio.transform.array_bounds(other.height, other.width, other.transform)
+        left, bottom, right, top = transform_bounds(left, bottom, right, top, other.crs, grid.crs)
+        scene_cols, scene_rows = ~grid.transform * (np.array([left, right, left, right]), np.array([bottom, bottom, top, top]))
+        extent.append((np.floor(scene_rows.min()), np.ceil(scene_rows.max()), np.floor(scene_cols.min()), np.ceil(scene_cols.max())))
+    extent = np.array(extent)
+    row_start, row_stop = max(row_start, int(extent[:, 0].min())), min(row_stop, int(extent[:, 1].max()))
+    col_start, col_stop = max(col_start, int(extent[:, 2].min())), min(col_stop, int(extent[:, 3].max()))
+
+    result = (None, None)
+    if row_stop > row_start and col_stop > col_start:
+        window = rio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        labels = rio.features.rasterize(((g, k + 1) for k, g in enumerate(geometries)), out_shape=(window.height, window.width),
+                                        transform=rio.windows.transform(window, grid.transform), fill=0,
+                                        dtype=np.uint16 if zone_indices.size < 65535 else np.int32)
+        if labels.any():
+            result = (window, labels)
+
+    cache[label_key] = result
+    label_keys = [key for key in cache if key[0] == 'labels']
+    for old_key in label_keys[:-_MAX_CACHED_LABEL_IMAGES]:
+        del cache[old_key]
+    return result
+
+#Per-zone 256-bin histograms of one date's composite for the zones at zone_indices, every zone pixel counted once
+#Each zone is composited from the scenes whose footprint overlaps its bounding box, on the grid of the first of them,
+#exactly like composite_range_histogram does for that zone's polygon; zones that share those scenes are rasterized together
+#zones_gdf holds every zone of the run (EPSG:4326 from load_zones_file), cache is a dict owned by the caller
+def composite_zonal_histograms(scenes, zones_gdf, zone_indices, rule='first_valid', cache=None):
+    cache = {} if cache is None else cache
+    zone_indices = np.asarray(zone_indices)
+    histograms = np.zeros((zone_indices.size, 256), dtype=np.int64)
+    if ('bounds',) not in cache:
+        cache[('bounds',)] = zones_gdf.geometry.bounds.to_numpy()
+    zone_bounds = cache[('bounds',)][zone_indices]
+
+    # Same bounding box test as query_scenes
+    mbrs = np.array([scene['mbr'] for scene in scenes])
+    overlaps = ((zone_bounds[:, None, 2] >= mbrs[None, :, 0]) & (zone_bounds[:, None, 0] <= mbrs[None, :, 2]) &
+                (zone_bounds[:, None, 3] >= mbrs[None, :, 1]) & (zone_bounds[:, None, 1] <= mbrs[None, :, 3]))
+    patterns, pattern_of_zone = np.unique(overlaps, axis=0, return_inverse=True)
+
+    for p, pattern in enumerate(patterns):
+        if not pattern.any():
+            continue
+        members = np.nonzero(pattern_of_zone.ravel() == p)[0]
+        group = order_scenes([scene for scene, used in zip(scenes, pattern) if used], rule)
+        ref_grid = scene_grid(group[0])
+        window, labels = _zone_labels(zones_gdf, zone_indices[members], ref_grid, group, cache)
+        if window is None:
+            continue
+
+        # One bincount over (label - 1) * 256 + value gives every zone's histogram at once
+        for strip in range(0, labels.shape[0], _ZONE_STRIP_ROWS):
+            rows, cols = np.nonzero(labels[strip:strip + _ZONE_STRIP_ROWS])
+            if rows.size == 0:
+                continue
+            zone_labels = labels[strip + rows, cols].astype(np.int64)
+            composite = _composite_pixels(group, ref_grid, rows + strip + int(window.row_off), cols + int(window.col_off), rule)
+            codes = ((zone_labels - 1) << 8) | composite
+            histograms[members] += np.bincount(codes, minlength=members.size * 256).reshape(members.size, 256)
+    histograms[:, 0] = 0
+    return histograms
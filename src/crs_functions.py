@@ -0,0 +1,41 @@
+import threading as th
+from pyproj import CRS, Transformer
+
+# Points added along each edge when a rectangle is reprojected, so curved edges are not cut off
+DENSIFY_POINTS = 21
+
+# Transformer objects must not be shared between threads, so every thread keeps its own registry
+_registry = th.local()
+
+def _crs_key(crs):
+    if hasattr(crs, 'to_wkt'):
+        return crs.to_wkt()
+    return str(crs)
+
+#Memoized transformer for (src_crs, dst_crs), None when both describe the same CRS
+def get_transformer(src_crs, dst_crs):
+    key = (_crs_key(src_crs), _crs_key(dst_crs))
+    if key[0] == key[1]:
+        return None
+
+    transformers = getattr(_registry, 'transformers', None)
+    if transformers is None:
+        transformers = _registry.transformers = {}
+    if key not in transformers:
+        src, dst = CRS.from_user_input(key[0]), CRS.from_user_input(key[1])
+        transformers[key] = None if src == dst else Transformer.from_crs(src, dst, always_xy=True)
+    return transformers[key]
+
+#Transforms x (lon) and y (lat) scalars or arrays, the input is returned unchanged for identical CRSs
+def transform_xy(xs, ys, src_crs='EPSG:4326', dst_crs='EPSG:4326'):
+    transformer = get_transformer(src_crs, dst_crs)
+    if transformer is None:
+        return xs, ys
+    return transformer.transform(xs, ys)
+
+#Reprojects a rectangle to the MBR of its densified outline: [min_x, min_y, max_x, max_y]
+def transform_bounds(min_x, min_y, max_x, max_y, src_crs='EPSG:4326', dst_crs='EPSG:4326', densify_pts=DENSIFY_POINTS):
+    transformer = get_transformer(src_crs, dst_crs)
+    if transformer is None:
+        return [min_x, min_y, max_x, max_y]
+    return list(transformer.transform_bounds(min_x, min_y, max_x, max_y, densify_pts=densify_pts))
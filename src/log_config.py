@@ -14,3 +14,10 @@ console_handler.setFormatter(formatter)
 
 # Add the handler to the logger
 logger.addHandler(console_handler)
+
+#Console verbosity of the scripts: quiet shows errors only, verbose adds the per-file and per-date DEBUG lines
+#The logger level follows, so suppressed records are dropped before they are built
+def set_console_level(quiet=False, verbose=False):
+    level = logging.ERROR if quiet else logging.DEBUG if verbose else logging.INFO
+    console_handler.setLevel(level)
+    logger.setLevel(level)
@@ -0,0 +1,200 @@
+import os
+import io
+import json
+import time
+import threading as th
+import datetime as date
+from contextlib import contextmanager
+from log_config import logger
+
+METRICS_FORMATS = ('json', 'jsonl', 'prom')
+PROFILERS = ('cprofile', 'tracemalloc')
+_PROFILE_TOP = 25
+
+#Process-wide stage timers and counters; stages and counters are created on first use
+#Timings are wall-clock per call, so stages running on several threads can add up to more than the run time
+class Metrics:
+    def __init__(self):
+        self._lock = th.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+            self.started = time.time()
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                self._stages[stage] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    #Stages and counters gathered since the last reset or drain, which start over empty
+    def drain(self):
+        with self._lock:
+            delta = {'stages': self._stages, 'counters': self._counters}
+            self._stages, self._counters = {}, {}
+        return delta
+
+    #Adds the stages and counters drained in another process
+    def merge(self, delta):
+        with self._lock:
+            for stage, (calls, seconds, longest) in delta['stages'].items():
+                entry = self._stages.get(stage)
+                if entry is None:
+                    self._stages[stage] = [calls, seconds, longest]
+                else:
+                    entry[0] += calls
+                    entry[1] += seconds
+                    entry[2] = max(entry[2], longest)
+            for name, value in delta['counters'].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        with self._lock:
+            stages = {stage: {'calls': calls, 'seconds': round(seconds, 6), 'mean_ms': round(seconds / calls * 1000, 3),
+                              'max_ms': round(longest * 1000, 3)}
+                      for stage, (calls, seconds, longest) in sorted(self._stages.items())}
+            return {'elapsed_s': round(time.time() - self.started, 3), 'stages': stages, 'counters': dict(sorted(self._counters.items()))}
+
+metrics = Metrics()
+
+def stage_timer(stage):
+    return metrics.timer(stage)
+
+def count_metric(name, value=1):
+    metrics.count(name, value)
+
+#Process pool workers have their own metrics: run_with_metrics runs one task there and returns its result together
+#with the metrics of that task, and merged_results adds them to this process's metrics as bounded_map hands them back
+#Only for process pools, a thread running run_with_metrics would drain the metrics of the whole run
+def run_with_metrics(func, *args):
+    metrics.drain()
+    result = func(*args)
+    return result, metrics.drain()
+
+#(task, result) pairs of bounded_map(run_with_metrics, ((func,) + task ...)) as (task, result) with the metrics merged
+def merged_results(results):
+    for task, (result, delta) in results:
+        metrics.merge(delta)
+        yield task[1:], result
+
+#Summary of the run so far; extra sections (e.g. raster_cache=raster_cache_stats()) are added as they are
+def metrics_summary(command=None, **extra):
+    summary = metrics.summary()
+    summary.update(extra)
+    summary.update(command=command, finished_at=date.datetime.now().isoformat(timespec='seconds'))
+    return summary
+
+def _prometheus_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name).lower()
+
+#Prometheus text exposition format, e.g. for the node_exporter textfile collector
+def prometheus_text(summary, prefix='ndvi'):
+    labels = f'command="{summary.get("command") or ""}"'
+    lines = []
+    # Every sample of a metric family has to follow its TYPE line as one group
+    for metric, kind, value in (('stage_seconds_total', 'counter', lambda entry: entry['seconds']),
+                                ('stage_calls_total', 'counter', lambda entry: entry['calls']),
+                                ('stage_max_seconds', 'gauge', lambda entry: round(entry['max_ms'] / 1000, 6))):
+        lines.append(f'# TYPE {prefix}_{metric} {kind}')
+        lines += [f'{prefix}_{metric}{{{labels},stage="{stage}"}} {value(entry)}' for stage, entry in summary['stages'].items()]
+    for name, value in summary['counters'].items():
+        metric = f'{prefix}_{_prometheus_name(name)}_total'
+        lines += [f'# TYPE {metric} counter', f'{metric}{{{labels}}} {value}']
+    # Other sections (cache statistics) are exported as gauges named after their section and key
+    for section, values in summary.items():
+        if section in ('stages', 'counters') or not isinstance(values, dict):
+            continue
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metric = f'{prefix}_{_prometheus_name(section)}_{_prometheus_name(name)}'
+                lines += [f'# TYPE {metric} gauge', f'{metric}{{{labels}}} {value}']
+    lines += [f'# TYPE {prefix}_elapsed_seconds gauge', f'{prefix}_elapsed_seconds{{{labels}}} {summary["elapsed_s"]}']
+    return '\n'.join(lines) + '\n'
+
+#json overwrites the file, jsonl appends one line per run, prom writes a Prometheus textfile
+#json and prom go through a temp file so a collector never reads a partial file
+def write_metrics(summary, path, metrics_format='json'):
+    if metrics_format not in METRICS_FORMATS:
+        raise ValueError(f"Unknown metrics format {metrics_format}, expected one of {METRICS_FORMATS}")
+    if metrics_format == 'jsonl':
+        with open(path, 'a') as file:
+            file.write(json.dumps(summary) + '\n')
+        return
+    text = prometheus_text(summary) if metrics_format == 'prom' else json.dumps(summary, indent=2) + '\n'
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+#Logs the run's summary as one JSON line and writes it to path in metrics_format if given
+def report_metrics(command, path=None, metrics_format='json', **extra):
+    summary = metrics_summary(command, **extra)
+    logger.info(f"Run summary: {json.dumps(summary)}")
+    if path:
+        try:
+            write_metrics(summary, path, metrics_format)
+        except OSError as e:
+            logger.error(f"Error writing metrics to {path}: {e}")
+    return summary
+
+#Runs the body under cProfile or tracemalloc; the top entries are logged and the full result is written to output_path
+#(cProfile: a pstats file for snakeviz/pstats, tracemalloc: a text report)
+@contextmanager
+def profiled(profiler=None, output_path=None):
+    if profiler is None:
+        yield
+        return
+    if profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler {profiler}, expected one of {PROFILERS}")
+
+    if profiler == 'cprofile':
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(_PROFILE_TOP)
+            logger.info(f"cProfile, top {_PROFILE_TOP} by cumulative time:\n{report.getvalue()}")
+            if output_path:
+                profile.dump_stats(output_path)
+                logger.info(f"Profile written to {output_path}")
+    else:
+        import tracemalloc
+        tracemalloc.start(10)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats = snapshot.statistics('lineno')
+            lines = [f"Traced memory: {current / 1e6:.1f} MB at exit, {peak / 1e6:.1f} MB peak"]
+            lines += [str(stat) for stat in stats[:_PROFILE_TOP]]
+            logger.info("tracemalloc, top allocations still held at exit:\n" + '\n'.join(lines))
+            if output_path:
+                with open(output_path, 'w') as file:
+                    file.write('\n'.join(lines[:1] + [str(stat) for stat in stats]) + '\n')
+                logger.info(f"Allocation report written to {output_path}")
@@ -0,0 +1,199 @@
+import os
+import json
+import hashlib
+import threading as th
+import datetime as date
+from types import SimpleNamespace
+import numpy as np
+import rasterio as rio
+from raster_catalog import get_catalog_path, query_scenes
+from parallel_functions import bounded_map
+from log_config import logger
+
+CUBE_DIR_NAME = 'cube'
+DEFAULT_CUBE_TILE = 16
+# preload_cube_windows keeps at most this many bytes of windows per query (the other scenes are read date by date)
+# and reads them in passes of at most _HISTORY_BATCH_BYTES of chunks
+_HISTORY_MAX_BYTES = 256 << 20
+_HISTORY_BATCH_BYTES = 64 << 20
+
+#Scenes on one grid (same CRS, geotransform and shape, i.e. one Landsat path/row) share a cube
+def _grid_key(scene):
+    return (scene['crs'], tuple(scene['geotransform']), scene['width'], scene['height'])
+
+def _grid_id(key):
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+
+def _source_entry(root, scene):
+    stat = os.stat(scene['path'])
+    return {'path': os.path.relpath(scene['path'], root), 'date': scene['date'],
+            'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+def _read_meta(cube_dir):
+    try:
+        with open(os.path.join(cube_dir, 'cube.json')) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+#Writes one grid's cube: uint8 of shape (tile rows, tile cols, scenes, tile, tile), so the full
+#history of a tile is one contiguous chunk, scenes in catalog order (date, then id)
+def build_grid_cube(cube_dir, root, key, scenes, tile=DEFAULT_CUBE_TILE):
+    crs, geotransform, width, height = key
+    sources = [_source_entry(root, scene) for scene in scenes]
+    meta = _read_meta(cube_dir)
+    if meta is not None and meta['sources'] == sources and meta['tile'] == tile:
+        logger.info(f"Cube {cube_dir} is up to date")
+        return False
+
+    os.makedirs(cube_dir, exist_ok=True)
+    tile_rows, tile_cols = -(-height // tile), -(-width // tile)
+    data_path = os.path.join(cube_dir, 'cube.npy')
+    tmp_path = data_path + '.partial'
+    cube = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                     shape=(tile_rows, tile_cols, len(scenes), tile, tile))
+    padded = np.zeros((tile_rows * tile, tile_cols * tile), dtype=np.uint8)
+    try:
+        for t, scene in enumerate(scenes):
+            with rio.open(scene['path']) as dataset:
+                if dataset.dtypes[0] != 'uint8':
+                    raise ValueError(f"{scene['path']} is not a uint8 NDVI image")
+                padded[:height, :width] = dataset.read(1)
+            cube[:, :, t] = padded.reshape(tile_rows, tile, tile_cols, tile).transpose(0, 2, 1, 3)
+        cube.flush()
+        del cube
+        os.replace(tmp_path, data_path)
+    except Exception:
+        del cube
+        os.remove(tmp_path)
+        raise
+
+    meta = {'crs': crs, 'geotransform': list(geotransform), 'width': width, 'height': height, 'tile': tile,
+            'sources': sources, 'built_at': date.datetime.now().isoformat(timespec='seconds')}
+    tmp_meta = os.path.join(cube_dir, 'cube.json.partial')
+    with open(tmp_meta, 'w') as file:
+        json.dump(meta, file)
+    os.replace(tmp_meta, os.path.join(cube_dir, 'cube.json'))
+    logger.info(f"Built cube {cube_dir}: {len(scenes)} scenes of {width}x{height}")
+    return True
+
+#Builds or refreshes the cube of every grid in the archive's catalog, grids are built on up to `workers` threads
+def build_ndvi_cubes(ndvi_dir, tile=DEFAULT_CUBE_TILE, workers=1):
+    catalog_path = get_catalog_path(ndvi_dir)
+    root = os.path.dirname(os.path.abspath(catalog_path))
+    grids = {}
+    for scene in query_scenes(catalog_path, '0001-01-01', '9999-12-31', [-180, -90, 180, 90]):
+        grids.setdefault(_grid_key(scene), []).append(scene)
+
+    def build(key, scenes):
+        try:
+            return build_grid_cube(os.path.join(root, CUBE_DIR_NAME, _grid_id(key)), root, key, scenes, tile)
+        except Exception as e:
+            logger.warning(f"Error building cube for grid {_grid_id(key)}: {e}")
+            return None
+
+    built = sum(1 for _, result in bounded_map(build, grids.items(), workers=workers) if result)
+    logger.info(f"Cubes: {built} built, {len(grids) - built} up to date or failed in {os.path.join(root, CUBE_DIR_NAME)}")
+    return built
+
+_cube_cache = {}
+_cube_cache_lock = th.Lock()
+
+#Open cube in cube_dir, re-read whenever its cube.json changes so a rebuilt cube is picked up
+def _load_cube(cube_dir):
+    try:
+        mtime_ns = os.stat(os.path.join(cube_dir, 'cube.json')).st_mtime_ns
+    except OSError:
+        return None
+    with _cube_cache_lock:
+        cached = _cube_cache.get(cube_dir)
+    if cached is not None and cached.mtime_ns == mtime_ns:
+        return cached
+
+    meta = _read_meta(cube_dir)
+    if meta is None:
+        return None
+    root = os.path.dirname(os.path.dirname(cube_dir))
+    cached = SimpleNamespace(
+        path=cube_dir, mtime_ns=mtime_ns, tile=meta['tile'],
+        data=np.load(os.path.join(cube_dir, 'cube.npy'), mmap_mode='r'),
+        sources={os.path.join(root, source['path']): (t, source) for t, source in enumerate(meta['sources'])})
+    with _cube_cache_lock:
+        _cube_cache[cube_dir] = cached
+    return cached
+
+def load_ndvi_cubes(ndvi_dir):
+    root = os.path.dirname(os.path.abspath(get_catalog_path(ndvi_dir)))
+    cubes_dir = os.path.join(root, CUBE_DIR_NAME)
+    if not os.path.isdir(cubes_dir):
+        return []
+    cubes = (_load_cube(entry.path) for entry in os.scandir(cubes_dir) if entry.is_dir())
+    return [cube for cube in cubes if cube is not None]
+
+#Marks every scene that is in a cube built from its current file with scene['cube'] = (cube dir, time index)
+#Returns the number of scenes marked; the others keep being read from their files
+def attach_cubes(search_dir, scenes):
+    cubes = load_ndvi_cubes(search_dir) if scenes else []
+    attached = 0
+    for scene in scenes:
+        match = next((cube for cube in cubes if scene['path'] in cube.sources), None)
+        if match is None:
+            continue
+        t, source = match.sources[scene['path']]
+        try:
+            stat = os.stat(scene['path'])
+        except OSError:
+            continue
+        if stat.st_mtime_ns != source['mtime_ns'] or stat.st_size != source['size']:
+            logger.debug(f"Cube is stale for {scene['path']}, reading the scene file")
+            continue
+        scene['cube'] = (match.path, t)
+        attached += 1
+    return attached
+
+#Windows of the scenes at time indices `times` of a cube as a (scenes, rows, cols) array, read chunk by chunk
+def _read_cube_windows(cube, times, window):
+    tile = cube.tile
+    row_start, col_start = int(window.row_off), int(window.col_off)
+    row_stop, col_stop = row_start + int(window.height), col_start + int(window.width)
+    tr0, tr1 = row_start // tile, (row_stop - 1) // tile + 1
+    tc0, tc1 = col_start // tile, (col_stop - 1) // tile + 1
+
+    # (tile rows, tile cols, scenes, tile, tile) -> (scenes, rows, cols), cropped to the window
+    chunks = cube.data[tr0:tr1, tc0:tc1][:, :, times]
+    stack = chunks.transpose(2, 0, 3, 1, 4).reshape(len(times), (tr1 - tr0) * tile, (tc1 - tc0) * tile)
+    r0, c0 = row_start - tr0 * tile, col_start - tc0 * tile
+    return stack[:, r0:r0 + row_stop - row_start, c0:c0 + col_stop - col_start]
+
+#Reads a window of one scene from its cube, same result as reading the window from the scene file
+def read_cube_window(cube_dir, t, window):
+    cube = _load_cube(cube_dir)
+    if cube is None:
+        raise FileNotFoundError(f"No cube in {cube_dir}")
+    return _read_cube_windows(cube, [t], window)[0]
+
+#Reads the window window_of(scene) of every scene marked by attach_cubes with one read per cube for all its scenes,
+#so a pixel's history stays one contiguous read however the query is split into dates
+#Stores it as scene['cube_window'] = (window, data), which read_scene_window serves sub-windows from;
+#window_of gets the first scene of each cube (they all share its grid) and returns None when nothing needs reading
+def preload_cube_windows(scenes, window_of):
+    by_cube = {}
+    for scene in scenes:
+        if scene.get('cube') is not None:
+            by_cube.setdefault(scene['cube'][0], []).append(scene)
+
+    budget = _HISTORY_MAX_BYTES
+    for cube_dir, cube_scenes in by_cube.items():
+        cube = _load_cube(cube_dir)
+        window = window_of(cube_scenes[0]) if cube is not None else None
+        if window is None:
+            continue
+        cube_scenes = cube_scenes[:budget // (int(window.height) * int(window.width))]
+        budget -= len(cube_scenes) * int(window.height) * int(window.width)
+        padded_area = (int(window.height) + 2 * cube.tile) * (int(window.width) + 2 * cube.tile)
+        batch = max(1, _HISTORY_BATCH_BYTES // padded_area)
+        for start in range(0, len(cube_scenes), batch):
+            part = cube_scenes[start:start + batch]
+            stack = _read_cube_windows(cube, [scene['cube'][1] for scene in part], window)
+            for scene, data in zip(part, stack):
+                scene['cube_window'] = (window, data)
@@ -1,44 +1,46 @@
+import threading as th
+from collections import OrderedDict
 import rasterio as rio
+import rasterio.warp
+import rasterio.windows
+import rasterio.features
 import numpy as np
-from pyproj import Transformer
-import rioxarray as rxr
-from wkt_functions import load_wkt_as_geodataframe
-import geopandas
-def get_ndvi_value_from_latlon(latitude, longitude, file_path):
-    with rio.open(file_path) as dataset:
-        left, bottom, right, top = dataset.bounds
-        
-        nrows, ncols = dataset.height, dataset.width
-        
-        pixel_width = (right - left) / ncols
-        pixel_height = (top - bottom) / nrows
-        
-        if not (left <= longitude <= right and bottom <= latitude <= top):
-            print(f"Coordinates ({latitude}, {longitude}) are out of bounds for this image.")
-            return None
-        
-        col = int((longitude - left) / pixel_width)
-        row = int((top - latitude) / pixel_height)
-        
-        pixel_value = dataset.read(1)[row, col]
-        
-        return pixel_value
 
-def get_ndvi_from_range(wkt_string, raster_path='', crs='EPSG:4326'):
-    aoi_gdf = load_wkt_as_geodataframe(wkt_string, crs)
-    integer_array = []
-    
-    try:
-        ndvi_image = rxr.open_rasterio(raster_path)
-        aoi_gdf = aoi_gdf.to_crs(ndvi_image.rio.crs.to_string())
-        clipped_band = ndvi_image.rio.clip(aoi_gdf.geometry, from_disk=True)
-        masked_band_values = clipped_band.where(clipped_band > 0, np.nan).values
+_MAX_CACHED_MASKS = 256
+_mask_cache = OrderedDict()
+_mask_cache_lock = th.Lock()
 
-        cleaned_array = masked_band_values[~np.isnan(masked_band_values)]
-        integer_array = cleaned_array.astype(int)
+#Window of the AOI's bounding box in the raster and the AOI mask inside it (True = inside)
+#Cached per (AOI, CRS, geotransform, shape): scenes on the same grid reuse one rasterization
+#clip=False keeps the whole AOI on the raster's pixel grid, the window may then reach past the raster edges
+def get_aoi_window_and_mask(wkt_string, dataset, crs='EPSG:4326', clip=True):
+    key = (wkt_string, crs, dataset.crs.to_string(), tuple(dataset.transform)[:6], dataset.shape, clip)
+    with _mask_cache_lock:
+        if key in _mask_cache:
+            _mask_cache.move_to_end(key)
+            return _mask_cache[key]
 
-    except Exception as e:
-        print(f"An error occurred: {e} with file {raster_path}. NOT AN NDVI IMAGE")
-        pass
+    from shapely import wkt
+    from shapely.geometry import mapping
+    geometry = rio.warp.transform_geom(crs, dataset.crs, mapping(wkt.loads(wkt_string)))
+    min_x, min_y, max_x, max_y = rio.features.bounds(geometry)
+    cols, rows = ~dataset.transform * (np.array([min_x, max_x, min_x, max_x]), np.array([min_y, min_y, max_y, max_y]))
+    row_start, row_stop = int(np.floor(rows.min())), int(np.ceil(rows.max()))
+    col_start, col_stop = int(np.floor(cols.min())), int(np.ceil(cols.max()))
+    if clip:
+        row_start, row_stop = max(row_start, 0), min(row_stop, dataset.height)
+        col_start, col_stop = max(col_start, 0), min(col_stop, dataset.width)
 
-    return integer_array
\ No newline at end of file
+    if row_stop <= row_start or col_stop <= col_start:
+        result = (None, None)
+    else:
+        window = rio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        mask = rio.features.geometry_mask([geometry], out_shape=(window.height, window.width),
+                                          transform=rio.windows.transform(window, dataset.transform), invert=True)
+        result = (window, mask)
+
+    with _mask_cache_lock:
+        _mask_cache[key] = result
+        while len(_mask_cache) > _MAX_CACHED_MASKS:
+            _mask_cache.popitem(last=False)
+    return result
@@ -1,31 +1,40 @@
 import os
-import pandas as pd
+import json
+import time
+import hashlib
+import datetime as date
 from glob import glob
-from queue import Queue
-import threading as th
-from osgeo import gdal
 import numpy as np
-from bounding_box_functions import get_boundingbox
+from functools import partial
+from bounding_box_functions import get_grid_metadata
+from wkt_functions import bounds_to_wkt
+from raster_catalog import get_catalog_path, add_scene_to_catalog, load_manifest, record_manifest_entry, load_directory_states, record_directory_state
+from parallel_functions import bounded_map, pipeline_map
+from ndvi_kernel import ndvi_to_byte, normalize_ndvi
+from metrics import stage_timer, count_metric, run_with_metrics, merged_results
 from log_config import logger
-import unittest
 
 np.seterr(divide='ignore', invalid='ignore')
 
-def import_red_nir_bands(red_file_path, nir_file_path):
-    try:
-        red = gdal.Open(red_file_path)
-        nir = gdal.Open(nir_file_path)
+#GDAL (osgeo) and pandas are imported by the functions that use them, so the catalog and kernel helpers load without them
+def open_red_nir_datasets(red_file_path, nir_file_path):
+    from osgeo import gdal
+    red = gdal.Open(red_file_path)
+    nir = gdal.Open(nir_file_path)
+
+    if red is None or nir is None:
+        raise FileNotFoundError(f"Cannot open one of the files: {red_file_path} or {nir_file_path}")
+
+    if not np.allclose(red.GetGeoTransform(), nir.GetGeoTransform(), atol=1e-6) or red.GetProjection() != nir.GetProjection():
+        raise ValueError("Geotransform or projection of the bands do not match!")
 
-        if red is None or nir is None:
-            raise FileNotFoundError(f"Cannot open one of the files: {red_file_path} or {nir_file_path}")
+    return red, nir
 
+def import_red_nir_bands(red_file_path, nir_file_path):
+    try:
+        red, nir = open_red_nir_datasets(red_file_path, nir_file_path)
         red_gt = red.GetGeoTransform()
         red_proj = red.GetProjection()
-        nir_gt = nir.GetGeoTransform()
-        nir_proj = nir.GetProjection()
-
-        if not np.allclose(red_gt, nir_gt, atol=1e-6) or red_proj != nir_proj:
-            raise ValueError("Geotransform or projection of the bands do not match!")
 
         red_band = red.GetRasterBand(1)
         red_array = red_band.ReadAsArray() / 10000.0
@@ -57,19 +66,67 @@ def calculate_ndvi(red, nir):
         logger.error("Error in calculate_ndvi: Calculation failed")
         return np.full(red.shape, np.nan)
 
-def normalize_ndvi(ndvi):
-    ndvi_min = -1
-    ndvi_max = 1
-    ndvi_normalized = 1 + ((ndvi - ndvi_min) * (255 - 1)) / (ndvi_max - ndvi_min)
-    return np.round(ndvi_normalized).astype(int)
-
-def denormalize_ndvi(ndvi_normalized):
-    ndvi_min = -1
-    ndvi_max = 1
-    ndvi = ndvi_min + ((ndvi_normalized - 1) / (255 - 1)) * (ndvi_max - ndvi_min)
-    return ndvi
-
-def export_ndvi_image(ndvi, gt, proj, file_name, file_path='', quality='60'):
+OUTPUT_FORMATS = ('gtiff', 'cog')
+OUTPUT_CODECS = ('jpeg', 'deflate', 'zstd', 'lzw')
+COG_BLOCK_SIZE = 512
+
+#gtiff with jpeg is the original striped layout; cog writes tiled files with internal overviews
+def make_output_profile(output_format='gtiff', codec='jpeg', quality='60'):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}")
+    if codec not in OUTPUT_CODECS:
+        raise ValueError(f"Unknown codec {codec}, expected one of {OUTPUT_CODECS}")
+    return {'format': output_format, 'codec': codec, 'quality': str(quality)}
+
+def _creation_options(output_profile):
+    codec = output_profile['codec']
+    options = ["COMPRESS=" + codec.upper()]
+    if output_profile['format'] == 'cog':
+        options += ["BLOCKSIZE=" + str(COG_BLOCK_SIZE), "OVERVIEWS=AUTO", "OVERVIEW_RESAMPLING=AVERAGE"]
+        options.append("QUALITY=" + output_profile['quality'] if codec == 'jpeg' else "PREDICTOR=YES")
+    elif codec == 'jpeg':
+        options.append("JPEG_QUALITY=" + output_profile['quality'])
+    else:
+        options.append("PREDICTOR=2")
+    return options
+
+#Outputs are written under a temporary name and renamed into place once complete
+PARTIAL_SUFFIX = '.partial'
+COG_SCRATCH_SUFFIX = '.cog.tmp'
+
+def _create_ndvi_dataset(file_name, file_path, xsize, ysize, gt, proj, quality='60', output_profile=None):
+    from osgeo import gdal
+    output_profile = output_profile or make_output_profile(quality=quality)
+    driver = gdal.GetDriverByName("GTiff")
+    if ".tif" not in file_name:
+        file_name += ".tif"
+    file_name = os.path.join(file_path, file_name)
+
+    if output_profile['format'] == 'cog':
+        # The COG driver only supports CreateCopy, so blocks go to a tiled scratch file first
+        options = ["TILED=YES", f"BLOCKXSIZE={COG_BLOCK_SIZE}", f"BLOCKYSIZE={COG_BLOCK_SIZE}", "COMPRESS=NONE"]
+        outds = driver.Create(file_name + COG_SCRATCH_SUFFIX, xsize=xsize, ysize=ysize, bands=1, eType=gdal.GDT_Byte, options=options)
+    else:
+        outds = driver.Create(file_name + PARTIAL_SUFFIX, xsize=xsize, ysize=ysize, bands=1, eType=gdal.GDT_Byte, options=_creation_options(output_profile))
+    outds.SetGeoTransform(gt)
+    outds.SetProjection(proj)
+    return outds
+
+#Takes the name of the closed dataset from _create_ndvi_dataset and moves the finished file into place
+def _finish_ndvi_dataset(tmp_name, output_profile=None):
+    if tmp_name.endswith(COG_SCRATCH_SUFFIX):
+        from osgeo import gdal
+        file_name = tmp_name[:-len(COG_SCRATCH_SUFFIX)]
+        scratch = gdal.Open(tmp_name)
+        cogds = gdal.GetDriverByName("COG").CreateCopy(file_name + PARTIAL_SUFFIX, scratch, options=_creation_options(output_profile))
+        cogds = None
+        scratch = None
+        os.remove(tmp_name)
+    else:
+        file_name = tmp_name[:-len(PARTIAL_SUFFIX)]
+    os.replace(file_name + PARTIAL_SUFFIX, file_name)
+
+def export_ndvi_image(ndvi, gt, proj, file_name, file_path='', quality='60', output_profile=None):
     try:
         ndvi_normalized = normalize_ndvi(ndvi)
         binmask = np.where(ndvi_normalized > 0, 1, 0)
@@ -77,14 +134,7 @@ def export_ndvi_image(ndvi, gt, proj, file_name, file_path='', quality='60'):
         nodata_value = 0
         clipped_data[np.isnan(clipped_data)] = nodata_value
 
-        driver = gdal.GetDriverByName("GTiff")
-        if ".tif" not in file_name:
-            file_name += ".tif"
-        file_name = os.path.join(file_path, file_name)
-
-        outds = driver.Create(file_name, xsize=ndvi_normalized.shape[1], ysize=ndvi_normalized.shape[0], bands=1, eType=gdal.GDT_Byte, options=["COMPRESS=JPEG", "JPEG_QUALITY=" + str(quality)])
-        outds.SetGeoTransform(gt)
-        outds.SetProjection(proj)
+        outds = _create_ndvi_dataset(file_name, file_path, ndvi_normalized.shape[1], ndvi_normalized.shape[0], gt, proj, quality, output_profile)
 
         outband = outds.GetRasterBand(1)
         outband.WriteArray(ndvi_normalized)
@@ -92,82 +142,379 @@ def export_ndvi_image(ndvi, gt, proj, file_name, file_path='', quality='60'):
 
         outband.FlushCache()
         outband = None
+        tmp_name = outds.GetDescription()
         outds = None
+        _finish_ndvi_dataset(tmp_name, output_profile)
 
     except Exception as e:
         logger.error(f"Error in export_ndvi_image: Unable to save NDVI image. {e}")
 
-def initialize_queue(main_dir):
-    sub_directories = [d for d in os.listdir(main_dir) if os.path.isdir(os.path.join(main_dir, d))]
-    dir_queue = Queue()
-    for dir in sub_directories:
-        dir_queue.put(dir)
-        logger.info(f"Queued directory: {dir}")
-    return dir_queue
-
-def process_directory(main_dir, output_directory, dir_queue, quality='60'):
-    while not dir_queue.empty():
-        dir = dir_queue.get()
-        try:
-            process_single_directory(main_dir, output_directory, dir, quality)
-        except Exception:
-            logger.error(f"Error processing directory {dir}")
-        finally:
-            dir_queue.task_done()
+#Raw B4/B5 arrays of a scene with its geotransform and projection
+def read_red_nir_arrays(red_file_path, nir_file_path):
+    with stage_timer('read'):
+        red, nir = open_red_nir_datasets(red_file_path, nir_file_path)
+        red_array = red.GetRasterBand(1).ReadAsArray()
+        nir_array = nir.GetRasterBand(1).ReadAsArray()
+        if red_array is None or nir_array is None:
+            raise ValueError("Failed to read one of the arrays")
+    count_metric('bytes_read', os.path.getsize(red_file_path) + os.path.getsize(nir_file_path))
+    return red_array, nir_array, red.GetGeoTransform(), red.GetProjection()
 
-def process_single_directory(main_dir, output_directory, dir, quality='60'):
-    full_path = os.path.join(output_directory, dir)
-    os.makedirs(full_path, exist_ok=True)
+def write_ndvi_byte(ndvi_byte, gt, proj, file_name, file_path='', quality='60', output_profile=None):
+    with stage_timer('encode'):
+        nodata_value = 0
+        outds = _create_ndvi_dataset(file_name, file_path, ndvi_byte.shape[1], ndvi_byte.shape[0], gt, proj, quality, output_profile)
+        outband = outds.GetRasterBand(1)
+        outband.WriteArray(ndvi_byte)
+        outband.SetNoDataValue(nodata_value)
+
+        outband.FlushCache()
+        outband = None
+        tmp_name = outds.GetDescription()
+        outds = None
+        _finish_ndvi_dataset(tmp_name, output_profile)
 
-    curr_files = os.listdir(full_path)
-    curr_files = [file.split('.')[0] for file in curr_files]
+#Catalog metadata of an output from the grid it was written with, so the finished file is not opened again
+def ndvi_scene_metadata(gt, proj, width, height, valid_pixels):
+    metadata = get_grid_metadata(gt, proj, width, height)
+    metadata['valid_pixels'] = valid_pixels
+    return metadata
 
+#Whole-scene path through the fused kernel: raw reflectance in, uint8 NDVI out, no float64 temporaries
+#Returns the output's catalog metadata (see ndvi_scene_metadata), None on failure
+def convert_ndvi_image(red_file_path, nir_file_path, file_name, file_path='', quality='60', output_profile=None):
+    try:
+        red_array, nir_array, gt, proj = read_red_nir_arrays(red_file_path, nir_file_path)
+        with stage_timer('compute'):
+            ndvi_byte = ndvi_to_byte(red_array, nir_array)
+        del red_array, nir_array
+
+        write_ndvi_byte(ndvi_byte, gt, proj, file_name, file_path, quality, output_profile)
+        return ndvi_scene_metadata(gt, proj, ndvi_byte.shape[1], ndvi_byte.shape[0], int(np.count_nonzero(ndvi_byte)))
+
+    except Exception as e:
+        logger.error(f"Error in convert_ndvi_image: Unable to save NDVI image. {e}")
+        return None
+
+def _iter_block_windows(band, window_size=512):
+    block_x, block_y = band.GetBlockSize()
+    xsize, ysize = band.XSize, band.YSize
+    # Round the window up to whole blocks; striped inputs are read as full-width row bands
+    win_x = xsize if block_x >= xsize else block_x * max(1, window_size // block_x)
+    win_y = block_y * max(1, -(-window_size // block_y))
+    for y in range(0, ysize, win_y):
+        for x in range(0, xsize, win_x):
+            yield x, y, min(win_x, xsize - x), min(win_y, ysize - y)
+
+#Low-memory path: reads, converts and writes one block window at a time, peak memory is a few windows
+#Returns the output's catalog metadata (see ndvi_scene_metadata), None on failure
+def stream_ndvi_image(red_file_path, nir_file_path, file_name, file_path='', quality='60', window_size=512, output_profile=None):
+    try:
+        red, nir = open_red_nir_datasets(red_file_path, nir_file_path)
+        red_band = red.GetRasterBand(1)
+        nir_band = nir.GetRasterBand(1)
+        count_metric('bytes_read', os.path.getsize(red_file_path) + os.path.getsize(nir_file_path))
+
+        nodata_value = 0
+        outds = _create_ndvi_dataset(file_name, file_path, red.RasterXSize, red.RasterYSize, red.GetGeoTransform(), red.GetProjection(), quality, output_profile)
+        outband = outds.GetRasterBand(1)
+
+        out_buffers = {}
+        valid_pixels = 0
+        for x, y, w, h in _iter_block_windows(red_band, window_size):
+            out = out_buffers.setdefault((h, w), np.empty((h, w), dtype=np.uint8))
+            with stage_timer('read'):
+                red_block, nir_block = red_band.ReadAsArray(x, y, w, h), nir_band.ReadAsArray(x, y, w, h)
+            with stage_timer('compute'):
+                ndvi_to_byte(red_block, nir_block, out=out)
+                valid_pixels += int(np.count_nonzero(out))
+            with stage_timer('encode'):
+                outband.WriteArray(out, x, y)
+
+        with stage_timer('encode'):
+            outband.SetNoDataValue(nodata_value)
+            outband.FlushCache()
+            outband = None
+            tmp_name = outds.GetDescription()
+            outds = None
+            _finish_ndvi_dataset(tmp_name, output_profile)
+        return ndvi_scene_metadata(red.GetGeoTransform(), red.GetProjection(), red.RasterXSize, red.RasterYSize, valid_pixels)
+
+    except Exception as e:
+        logger.error(f"Error in stream_ndvi_image: Unable to save NDVI image. {e}")
+        return None
+
+def find_band_pairs(main_dir, dir):
     band_4_files = glob(os.path.join(main_dir, dir, "*_B4.TIF"))
-    band_5_files = glob(os.path.join(main_dir, dir, "*_B5.TIF"))
 
     valid_file_pairs = []
-    for band4 in band_4_files:
+    for band4 in sorted(band_4_files):
         base_name = os.path.basename(band4).replace('_B4.TIF', '')
         band5 = os.path.join(main_dir, dir, base_name + "_B5.TIF")
         if os.path.exists(band5):
             valid_file_pairs.append((band4, band5, base_name))
         else:
             logger.error(f"Band 5 missing for {base_name}, skipping this pair.")
-
-    raster_dict = {'FileName': [], 'MBR': []}
-
-    for band4, band5, file_name in valid_file_pairs:
-        if file_name not in curr_files:
-            red, nir, gt, proj = import_red_nir_bands(band4, band5)
-            
-            if red is not None and nir is not None:
-                ndvi = calculate_ndvi(red, nir)
-                export_ndvi_image(ndvi, gt, proj, file_name, full_path, quality)
-                logger.info(f"File {file_name} has been created in {full_path}")
-
-                raster_path = os.path.join(full_path, file_name)
-                MBR = get_boundingbox(raster_path + '.TIF')
-                raster_dict['FileName'].append(file_name)
-                raster_dict['MBR'].append(MBR)
+    return valid_file_pairs
+
+#Converts one B4/B5 pair and returns its catalog metadata, or None if the bands could not be read
+def process_scene(band4, band5, file_name, full_path, quality='60', streaming=False, output_profile=None):
+    if streaming:
+        metadata = stream_ndvi_image(band4, band5, file_name, full_path, quality, output_profile=output_profile)
+        if metadata is None:
+            logger.error(f"Skipping file {file_name} due to errors streaming bands.")
+            return None
+    else:
+        metadata = convert_ndvi_image(band4, band5, file_name, full_path, quality, output_profile)
+        if metadata is None:
+            logger.error(f"Skipping file {file_name} due to errors reading bands.")
+            return None
+    return _add_output_metadata(metadata, file_name, full_path)
+
+#Adds the output's path, size and checksum recorded in the manifest
+def _add_output_metadata(metadata, file_name, full_path):
+    logger.debug(f"File {file_name} has been created in {full_path}")
+    raster_path = os.path.join(full_path, file_name + '.tif')
+    metadata['raster_path'] = raster_path
+    metadata['output_size'] = os.path.getsize(raster_path)
+    count_metric('bytes_written', metadata['output_size'])
+    with stage_timer('checksum'):
+        metadata['output_sha256'] = file_checksum(raster_path)
+    return metadata
+
+def file_checksum(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def input_signature(band4, band5):
+    red_stat, nir_stat = os.stat(band4), os.stat(band5)
+    return {'red_size': red_stat.st_size, 'red_mtime_ns': red_stat.st_mtime_ns,
+            'nir_size': nir_stat.st_size, 'nir_mtime_ns': nir_stat.st_mtime_ns}
+
+#Everything that changes the bytes of an output; a different value forces reprocessing in incremental mode
+def processing_params(quality='60', output_profile=None):
+    return json.dumps(output_profile or make_output_profile(quality=quality), sort_keys=True)
+
+#Merges new rows into a directory's raster_index.csv through a temp file so readers never see a partial index
+def update_raster_index(full_path, raster_dict):
+    import pandas as pd
+    raster_index_path = os.path.join(full_path, 'raster_index.csv')
+    raster_index = pd.DataFrame(raster_dict)
+    if os.path.isfile(raster_index_path):
+        existing_index = pd.read_csv(raster_index_path, index_col=0)
+        raster_index = pd.concat([existing_index, raster_index], ignore_index=True)
+        raster_index = raster_index.drop_duplicates(subset='FileName', keep='last').reset_index(drop=True)
+
+    tmp_path = raster_index_path + '.tmp'
+    raster_index.to_csv(tmp_path)
+    os.replace(tmp_path, raster_index_path)
+
+def _record_scene(catalog_path, dir, file_name, metadata, raster_dict, band4, band5, params):
+    raster_path = metadata.pop('raster_path')
+    output_size = metadata.pop('output_size')
+    output_sha256 = metadata.pop('output_sha256')
+    add_scene_to_catalog(catalog_path, dir, raster_path, **metadata)
+    record_manifest_entry(catalog_path, raster_path, dir, file_name, input_signature(band4, band5), params, output_size, output_sha256)
+    raster_dict['FileName'].append(file_name)
+    raster_dict['MBR'].append(bounds_to_wkt(*metadata['mbr']))
+
+#Lists finished outputs and clears temporaries left behind by an interrupted run
+def _existing_outputs(full_path):
+    curr_files = []
+    for file in os.listdir(full_path):
+        if file.endswith(PARTIAL_SUFFIX) or file.endswith(COG_SCRATCH_SUFFIX):
+            logger.warning(f"Removing incomplete output {file} in {full_path}")
+            os.remove(os.path.join(full_path, file))
+        elif file.endswith('.tif'):
+            curr_files.append(file.split('.')[0])
+    return curr_files
+
+#Date folders (YYYY-MM-DD) of the input; other folders are left alone, the catalog is keyed by date
+def _list_input_directories(main_dir):
+    dirs = []
+    for d in sorted(os.listdir(main_dir)):
+        if not os.path.isdir(os.path.join(main_dir, d)):
+            continue
+        try:
+            date.datetime.strptime(d, '%Y-%m-%d')
+        except ValueError:
+            logger.warning(f"Skipping folder {d} in {main_dir}, its name is not a YYYY-MM-DD date")
+            continue
+        dirs.append(d)
+    return dirs
+
+#Lists every scene pair still to convert; one task per scene so large date folders spread across workers
+def collect_scene_tasks(main_dir, output_directory):
+    tasks = []
+    for dir in _list_input_directories(main_dir):
+        full_path = os.path.join(output_directory, dir)
+        os.makedirs(full_path, exist_ok=True)
+        curr_files = _existing_outputs(full_path)
+
+        for band4, band5, file_name in find_band_pairs(main_dir, dir):
+            if file_name not in curr_files:
+                tasks.append((dir, band4, band5, file_name, full_path))
             else:
-                logger.error(f"Skipping file {file_name} due to errors reading bands.")
-        else:
-            logger.info(f"File {file_name} already exists, skipping.")
+                count_metric('scenes_skipped')
+                logger.debug(f"File {file_name} already exists, skipping.")
+    return tasks
+
+def _is_output_current(entry, signature, params, raster_path, verify=False):
+    if entry is None or entry['params'] != params:
+        return False
+    if any(entry[key] != value for key, value in signature.items()):
+        return False
+    if not os.path.isfile(raster_path) or os.path.getsize(raster_path) != entry['output_size']:
+        return False
+    return not verify or file_checksum(raster_path) == entry['output_sha256']
+
+#Incremental variant: folders whose mtime and parameters match the last complete run are not even listed,
+#inside other folders only new, changed or incomplete scenes are queued
+def collect_incremental_scene_tasks(main_dir, output_directory, params, verify=False):
+    catalog_path = get_catalog_path(output_directory)
+    manifest = load_manifest(catalog_path)
+    directory_states = load_directory_states(catalog_path)
+
+    tasks = []
+    listed_dirs = {}
+    for dir in _list_input_directories(main_dir):
+        mtime_ns = os.stat(os.path.join(main_dir, dir)).st_mtime_ns
+        state = directory_states.get(dir)
+        if not verify and state is not None and state['mtime_ns'] == mtime_ns and state['params'] == params:
+            count_metric('directories_skipped')
+            continue
+
+        listed_dirs[dir] = mtime_ns
+        full_path = os.path.join(output_directory, dir)
+        os.makedirs(full_path, exist_ok=True)
+        _existing_outputs(full_path)
+
+        for band4, band5, file_name in find_band_pairs(main_dir, dir):
+            raster_path = os.path.join(full_path, file_name + '.tif')
+            entry = manifest.get(os.path.relpath(os.path.abspath(raster_path), os.path.abspath(output_directory)))
+            if _is_output_current(entry, input_signature(band4, band5), params, raster_path, verify):
+                count_metric('scenes_skipped')
+                continue
+            tasks.append((dir, band4, band5, file_name, full_path))
+    return tasks, listed_dirs
+
+def _process_scene_task(dir, band4, band5, file_name, full_path, quality='60', streaming=False, output_profile=None):
+    try:
+        return process_scene(band4, band5, file_name, full_path, quality, streaming, output_profile)
+    except Exception as e:
+        logger.error(f"Error processing scene {file_name} in {dir}: {e}")
+        return None
 
-    raster_index_path = os.path.join(full_path, 'raster_index.csv')
-    if not os.path.isfile(raster_index_path): 
-        raster_index = pd.DataFrame(raster_dict)
-        raster_index.to_csv(raster_index_path)
-
-
-def create_and_start_threads(main_dir, output_directory, dir_queue, num_threads=4, quality='60'):
-    threads = []
-    for _ in range(num_threads):
-        thread = th.Thread(target=process_directory, args=(main_dir, output_directory, dir_queue, quality))
-        thread.start()
-        threads.append(thread)
-    return threads
-
-def wait_for_threads_to_complete(threads):
-    for thread in threads:
-        thread.join()
+#Stages of the ingest pipeline: the reader loads a scene's bands, the compute stage turns them into uint8 NDVI
+#and the writer encodes the output; each returns None on failure so the scene is skipped like in process_scene
+def _read_scene_stage(dir, band4, band5, file_name, full_path):
+    try:
+        red_array, nir_array, gt, proj = read_red_nir_arrays(band4, band5)
+    except Exception as e:
+        logger.error(f"Skipping file {file_name} in {dir} due to errors reading bands. {e}")
+        return None
+    return {'file_name': file_name, 'full_path': full_path, 'red': red_array, 'nir': nir_array, 'gt': gt, 'proj': proj}
+
+def _compute_scene_stage(scene):
+    try:
+        with stage_timer('compute'):
+            scene['ndvi'] = ndvi_to_byte(scene.pop('red'), scene.pop('nir'))
+            scene['valid_pixels'] = int(np.count_nonzero(scene['ndvi']))
+    except Exception as e:
+        logger.error(f"Error computing NDVI of {scene['file_name']}: {e}")
+        return None
+    return scene
+
+def _write_scene_stage(scene, quality='60', output_profile=None):
+    ndvi_byte = scene['ndvi']
+    try:
+        write_ndvi_byte(ndvi_byte, scene['gt'], scene['proj'], scene['file_name'], scene['full_path'], quality, output_profile)
+        metadata = ndvi_scene_metadata(scene['gt'], scene['proj'], ndvi_byte.shape[1], ndvi_byte.shape[0], scene['valid_pixels'])
+        return _add_output_metadata(metadata, scene['file_name'], scene['full_path'])
+    except Exception as e:
+        logger.error(f"Error in write_ndvi_byte: Unable to save NDVI image {scene['file_name']}. {e}")
+        return None
+
+PROGRESS_INTERVAL_S = 10
+
+#Workers only convert scenes; the catalog, manifest and raster_index.csv files are written by this (single) caller
+#With pipeline=True, readers, workers (compute) and writers threads run the three stages above, joined by queues
+#of at most queue_size scenes, so storage reads and writes overlap the NDVI computation
+def run_scene_pool(main_dir, output_directory, workers=None, executor='thread', quality='60', max_in_flight=None, streaming=False, output_profile=None, incremental=False, verify=False,
+                   pipeline=False, readers=1, writers=1, queue_size=2):
+    if pipeline and (streaming or executor != 'thread'):
+        raise ValueError("The ingest pipeline runs whole scenes on threads, it cannot be combined with streaming or a process executor")
+    os.makedirs(output_directory, exist_ok=True)
+    catalog_path = get_catalog_path(output_directory)
+    params = processing_params(quality, output_profile)
+    if incremental:
+        tasks, listed_dirs = collect_incremental_scene_tasks(main_dir, output_directory, params, verify)
+    else:
+        tasks, listed_dirs = collect_scene_tasks(main_dir, output_directory), {}
+    if pipeline:
+        logger.info(f"Queued {len(tasks)} scenes on a pipeline of {readers} readers, {workers or os.cpu_count()} compute and {writers} writer threads")
+    else:
+        logger.info(f"Queued {len(tasks)} scenes on {workers or os.cpu_count()} {executor} workers")
+
+    pending = {dir: 0 for dir in listed_dirs}
+    for task in tasks:
+        pending[task[0]] = pending.get(task[0], 0) + 1
+    failed_dirs = set()
+
+    def finish_directory(dir):
+        if dir in listed_dirs and dir not in failed_dirs:
+            record_directory_state(catalog_path, dir, listed_dirs[dir], params)
+
+    for dir, count in pending.items():
+        if count == 0:
+            finish_directory(dir)
+
+    raster_dicts = {}
+    if pipeline:
+        stages = [(_read_scene_stage, readers), (_compute_scene_stage, workers or os.cpu_count()),
+                  (partial(_write_scene_stage, quality=quality, output_profile=output_profile), writers)]
+        results = pipeline_map(stages, tasks, queue_size)
+    else:
+        work = ((dir, band4, band5, file_name, full_path, quality, streaming, output_profile) for dir, band4, band5, file_name, full_path in tasks)
+        if executor == 'process':
+            # The read, compute, encode and checksum timings and byte counters come back from the workers with each scene
+            work = ((_process_scene_task,) + task for task in work)
+            results = merged_results(bounded_map(run_with_metrics, work, workers=workers, executor=executor,
+                                                 max_in_flight=max_in_flight, ordered=False))
+        else:
+            results = bounded_map(_process_scene_task, work, workers=workers, executor=executor,
+                                  max_in_flight=max_in_flight, ordered=False)
+
+    done, failed = 0, 0
+    started = last_report = time.time()
+    for task, metadata in results:
+        dir, band4, band5, file_name, full_path = task[:5]
+        raster_dict = raster_dicts.setdefault(full_path, {'FileName': [], 'MBR': []})
+        with stage_timer('index'):
+            if metadata is not None:
+                try:
+                    _record_scene(catalog_path, dir, file_name, metadata, raster_dict, band4, band5, params)
+                except Exception as e:
+                    logger.error(f"Error recording scene {file_name} in {dir}: {e}")
+                    metadata = None
+            if metadata is not None:
+                count_metric('scenes_processed')
+            else:
+                failed_dirs.add(dir)
+                failed += 1
+                count_metric('scenes_failed')
+
+            pending[dir] -= 1
+            if pending[dir] == 0:
+                update_raster_index(full_path, raster_dict)
+                raster_dicts.pop(full_path)
+                finish_directory(dir)
+
+        # One progress line every few seconds instead of one line per file
+        done += 1
+        if time.time() - last_report >= PROGRESS_INTERVAL_S or done == len(tasks):
+            last_report = time.time()
+            logger.info(f"Processed {done}/{len(tasks)} scenes, {failed} failed ({done / max(last_report - started, 1e-9):.1f} scenes/s)")
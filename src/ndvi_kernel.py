@@ -0,0 +1,120 @@
+import os
+import threading as th
+import importlib.util
+import numpy as np
+
+# numba takes about half a second to import, so it is only imported (and the loop compiled) when the numba backend first runs
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+
+KERNEL_BACKENDS = ('auto', 'numpy', 'numba')
+
+# Rows are processed in chunks of about this many pixels so the float64 scratch stays in cache
+_CHUNK_PIXELS = 1 << 15
+# Reflectance scale of the original chain (red / 10000.0, nir / 10000.0), kept so the float64 rounding is the same
+_REFLECTANCE_SCALE = 10000.0
+
+def normalize_ndvi(ndvi):
+    ndvi_min = -1
+    ndvi_max = 1
+    ndvi_normalized = 1 + ((ndvi - ndvi_min) * (255 - 1)) / (ndvi_max - ndvi_min)
+    return np.round(ndvi_normalized).astype(int)
+
+def denormalize_ndvi(ndvi_normalized):
+    ndvi_min = -1
+    ndvi_max = 1
+    ndvi = ndvi_min + ((ndvi_normalized - 1) / (255 - 1)) * (ndvi_max - ndvi_min)
+    return ndvi
+
+#Encoding matches normalize_ndvi + export_ndvi_image: 1..255 for NDVI -1..1, 0 where both bands are 0 (nodata)
+#The arithmetic is the original calculate_ndvi/normalize_ndvi chain, operation for operation in float64,
+#so pixels on a rounding boundary get the same byte
+def _ndvi_to_byte_numpy(red, nir, out):
+    clip = not (np.issubdtype(red.dtype, np.unsignedinteger) and np.issubdtype(nir.dtype, np.unsignedinteger))
+    ncols = red.shape[1]
+    chunk_rows = max(1, _CHUNK_PIXELS // max(ncols, 1))
+    num = np.empty((chunk_rows, ncols), dtype=np.float64)
+    den = np.empty((chunk_rows, ncols), dtype=np.float64)
+    tmp = np.empty((chunk_rows, ncols), dtype=np.float64)
+
+    for row in range(0, red.shape[0], chunk_rows):
+        rows = min(chunk_rows, red.shape[0] - row)
+        r, n, o = red[row:row + rows], nir[row:row + rows], out[row:row + rows]
+        num_c, den_c, tmp_c = num[:rows], den[:rows], tmp[:rows]
+
+        np.divide(r, _REFLECTANCE_SCALE, out=tmp_c, dtype=np.float64)
+        np.divide(n, _REFLECTANCE_SCALE, out=num_c, dtype=np.float64)
+        np.add(num_c, tmp_c, out=den_c)
+        np.subtract(num_c, tmp_c, out=num_c)
+        np.divide(num_c, den_c, out=num_c)
+        if clip:
+            np.clip(num_c, -1, 1, out=num_c)
+        # 1 + ((ndvi + 1) * 254) / 2 like normalize_ndvi
+        np.add(num_c, 1, out=num_c)
+        np.multiply(num_c, 254, out=num_c)
+        np.divide(num_c, 2, out=num_c)
+        np.add(num_c, 1, out=num_c)
+        np.rint(num_c, out=num_c)
+        # fmax drops the NaN from 0/0 in favour of 0, valid values are always >= 1
+        np.fmax(num_c, 0, out=num_c)
+        np.copyto(o, num_c, casting='unsafe')
+    return out
+
+#Compiled by numba.njit in _numba_kernel; same results as _ndvi_to_byte_numpy for every dtype: 0/0 and NaN give 0,
+#a zero sum of signed bands with a non-zero difference is +-inf there and clips to 255 or 1
+def _ndvi_to_byte_loop(red, nir, out):
+    for i in range(red.shape[0]):
+        for j in range(red.shape[1]):
+            r = np.float64(red[i, j]) / _REFLECTANCE_SCALE
+            n = np.float64(nir[i, j]) / _REFLECTANCE_SCALE
+            s = n + r
+            d = n - r
+            if s == 0:
+                if d > 0:
+                    out[i, j] = 255
+                elif d < 0:
+                    out[i, j] = 1
+                else:
+                    out[i, j] = 0
+                continue
+            v = d / s
+            if v != v:
+                out[i, j] = 0
+                continue
+            if v > 1:
+                v = 1.0
+            elif v < -1:
+                v = -1.0
+            out[i, j] = np.uint8(np.rint(((v + 1) * 254) / 2 + 1))
+    return out
+
+_ndvi_to_byte_numba = None
+_numba_lock = th.Lock()
+
+def _numba_kernel():
+    global _ndvi_to_byte_numba
+    with _numba_lock:
+        if _ndvi_to_byte_numba is None:
+            import numba
+            _ndvi_to_byte_numba = numba.njit(cache=True, nogil=True)(_ndvi_to_byte_loop)
+    return _ndvi_to_byte_numba
+
+def resolve_kernel_backend(backend=None):
+    backend = backend or os.environ.get('NDVI_KERNEL_BACKEND', 'auto')
+    if backend not in KERNEL_BACKENDS:
+        raise ValueError(f"Unknown NDVI kernel backend {backend}, expected one of {KERNEL_BACKENDS}")
+    if backend == 'auto':
+        return 'numba' if HAVE_NUMBA else 'numpy'
+    if backend == 'numba' and not HAVE_NUMBA:
+        raise ImportError("numba is not installed, use the numpy NDVI kernel backend")
+    return backend
+
+#Converts red/nir reflectance (any numeric dtype, usually uint16) straight to the uint8 NDVI encoding
+def ndvi_to_byte(red, nir, out=None, backend=None):
+    if red.shape != nir.shape:
+        raise ValueError("Red and NIR arrays must have the same shape")
+    if out is None:
+        out = np.empty(red.shape, dtype=np.uint8)
+
+    if resolve_kernel_backend(backend) == 'numba':
+        return _numba_kernel()(red, nir, out)
+    return _ndvi_to_byte_numpy(red, nir, out)
@@ -0,0 +1,216 @@
+import os
+import csv
+import gzip
+import shutil
+import datetime as date
+import numpy as np
+from log_config import logger
+
+SERIES_FORMATS = ('csv', 'parquet')
+NDVI_DTYPES = ('float32', 'float64', 'uint8')
+PARTITIONS = ('none', 'year')
+PARQUET_COMPRESSION = 'zstd'
+# Row dicts given to write_series_records are written in batches of this many rows
+RECORD_BATCH_ROWS = 512
+
+# Columns holding the NDVI of one pixel; with uint8 they are stored as the archive's 1..255 codes (0 = no data)
+_PIXEL_NDVI_COLUMNS = ('PixelValue', 'NDVI', 'NDVI_MIN', 'NDVI_MAX')
+# Means and medians fall between codes and stay float32
+_STATISTIC_NDVI_COLUMNS = ('NDVI_MEDIAN', 'NDVI_MEAN')
+
+#Same coding as normalize_ndvi in ndvi_kernel, with NaN as 0
+def ndvi_to_codes(ndvi):
+    ndvi = np.asarray(ndvi, dtype=np.float64)
+    codes = np.zeros(ndvi.shape, dtype=np.uint8)
+    valid = ~np.isnan(ndvi)
+    codes[valid] = np.clip(np.rint(1 + (ndvi[valid] + 1) * 127), 1, 255)
+    return codes
+
+#Smallest dtypes that hold a series: float32 (or uint8 codes) NDVI, categorical file names, uint32 pixel counts
+def compact_frame(df, ndvi_dtype='float32'):
+    if ndvi_dtype not in NDVI_DTYPES:
+        raise ValueError(f"Unknown NDVI dtype {ndvi_dtype}, expected one of {NDVI_DTYPES}")
+    df = df.copy()
+    for column in df.columns:
+        if column in _PIXEL_NDVI_COLUMNS and ndvi_dtype == 'uint8':
+            df[column] = ndvi_to_codes(df[column])
+        elif column in _PIXEL_NDVI_COLUMNS + _STATISTIC_NDVI_COLUMNS:
+            df[column] = df[column].astype('float64' if ndvi_dtype == 'float64' else 'float32')
+    if 'File' in df.columns:
+        df['File'] = df['File'].astype('category')
+    if 'PixelCount' in df.columns:
+        df['PixelCount'] = df['PixelCount'].astype(np.uint32)
+    return df
+
+#One CSV cell as pandas.to_csv writes it after compact_frame, for records written without pandas
+def _csv_cell(column, value, ndvi_dtype):
+    if value is None:
+        return ''
+    if isinstance(value, date.datetime):
+        return value.strftime('%Y-%m-%d') if value.time() == date.time() else str(value)
+    if column in _PIXEL_NDVI_COLUMNS and ndvi_dtype == 'uint8':
+        return str(ndvi_to_codes(value).item())
+    if column in _PIXEL_NDVI_COLUMNS + _STATISTIC_NDVI_COLUMNS:
+        if np.isnan(value):
+            return ''
+        return str(np.float32(value)) if ndvi_dtype == 'float32' else repr(float(value))
+    return str(value)
+
+#Writes a series chunk by chunk as it is extracted, so only one chunk is held in memory
+#csv: one file with a header, gzip-compressed when the path ends in .gz
+#Row dicts (write_records) go to csv through the csv module, so a csv series needs no pandas
+#parquet: zstd-compressed, one file, or with partition='year' a directory of year=YYYY/part-0.parquet (hive layout, read back with
+#pandas.read_parquet or pyarrow.dataset); every chunk is cast to the schema of the first one
+#Output goes to <path>.partial and replaces path on a clean exit, so a failed run never leaves a truncated series behind
+class SeriesWriter:
+    def __init__(self, path, output_format='csv', ndvi_dtype='float32', partition='none', columns=None):
+        if output_format not in SERIES_FORMATS:
+            raise ValueError(f"Unknown output format {output_format}, expected one of {SERIES_FORMATS}")
+        if partition not in PARTITIONS:
+            raise ValueError(f"Unknown partitioning {partition}, expected one of {PARTITIONS}")
+        if ndvi_dtype not in NDVI_DTYPES:
+            raise ValueError(f"Unknown NDVI dtype {ndvi_dtype}, expected one of {NDVI_DTYPES}")
+        if partition != 'none' and output_format != 'parquet':
+            raise ValueError("Only parquet output can be partitioned")
+        self.path = path
+        self.output_format = output_format
+        self.ndvi_dtype = ndvi_dtype
+        self.partition = partition
+        self.columns = columns
+        self.partial_path = path + '.partial'
+        self.rows = 0
+        self._csv_file = None
+        self._schema = None
+        self._parquet_writers = {}
+        _remove_path(self.partial_path)
+        if partition != 'none':
+            os.makedirs(self.partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(commit=exc_type is None)
+        return False
+
+    def write(self, df):
+        if len(df) == 0:
+            return
+        df = compact_frame(df, self.ndvi_dtype)
+        if self.output_format == 'csv':
+            self._write_csv(df)
+        else:
+            self._write_parquet(df)
+        self.rows += len(df)
+
+    #records: a list of dicts, missing keys are written as empty values
+    def write_records(self, records):
+        if len(records) == 0:
+            return
+        if self.output_format != 'csv':
+            import pandas as pd
+            self.write(pd.DataFrame(records, columns=self.columns))
+            return
+        columns = self.columns or list(records[0])
+        writer = self._csv_writer(columns)
+        writer.writerows([_csv_cell(column, record.get(column), self.ndvi_dtype) for column in columns] for record in records)
+        self.rows += len(records)
+
+    def _open_csv(self):
+        header = self._csv_file is None
+        if header:
+            self._csv_file = gzip.open(self.partial_path, 'wt', newline='') if self.path.endswith('.gz') else open(self.partial_path, 'w', newline='')
+        return header
+
+    def _csv_writer(self, columns):
+        header = self._open_csv()
+        writer = csv.writer(self._csv_file, lineterminator='\n')
+        if header:
+            writer.writerow(columns)
+        return writer
+
+    def _write_csv(self, df):
+        header = self._open_csv()
+        df.to_csv(self._csv_file, header=header, index=False)
+
+    def _write_parquet(self, df):
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.partition == 'year':
+            years = pd.to_datetime(df['Date']).dt.year.to_numpy()
+            parts = [(int(year), df[years == year]) for year in np.unique(years)]
+        else:
+            parts = [(None, df)]
+
+        for year, part in parts:
+            table = pa.Table.from_pandas(part, preserve_index=False)
+            if self._schema is None:
+                # Categories differ between chunks: wide dictionary indices keep every chunk castable to one schema
+                fields = [pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type)) if pa.types.is_dictionary(field.type) else field
+                          for field in table.schema]
+                self._schema = pa.schema(fields, metadata=table.schema.metadata)
+            table = table.cast(self._schema)
+
+            writer = self._parquet_writers.get(year)
+            if writer is None:
+                file_path = self.partial_path
+                if year is not None:
+                    file_path = os.path.join(self.partial_path, f'year={year}', 'part-0.parquet')
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                writer = pq.ParquetWriter(file_path, self._schema, compression=PARQUET_COMPRESSION)
+                self._parquet_writers[year] = writer
+            writer.write_table(table)
+
+    #An empty series still gets its header (csv) or an empty table (unpartitioned parquet)
+    def _write_empty(self):
+        if self.output_format == 'csv':
+            self._csv_writer(self.columns or [])
+        elif self.partition == 'none':
+            import pandas as pd
+            pd.DataFrame(columns=self.columns or []).to_parquet(self.partial_path, index=False, compression=PARQUET_COMPRESSION)
+
+    def close(self, commit=True):
+        try:
+            if commit and self.rows == 0:
+                self._write_empty()
+        finally:
+            if self._csv_file is not None:
+                self._csv_file.close()
+                self._csv_file = None
+            for writer in self._parquet_writers.values():
+                writer.close()
+            self._parquet_writers = {}
+
+        if not commit:
+            _remove_path(self.partial_path)
+            return
+        _remove_path(self.path)
+        os.replace(self.partial_path, self.path)
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+#Streams the DataFrame chunks of one of the iter_* time series into path; returns the number of rows written
+def write_series(frames, path, output_format='csv', ndvi_dtype='float32', partition='none', columns=None):
+    with SeriesWriter(path, output_format, ndvi_dtype, partition, columns) as writer:
+        for frame in frames:
+            writer.write(frame)
+            logger.debug("Time series rows: %s", frame)
+    return writer.rows
+
+#Same for a generator of row dicts such as iter_point_records
+def write_series_records(records, path, output_format='csv', ndvi_dtype='float32', partition='none', columns=None):
+    with SeriesWriter(path, output_format, ndvi_dtype, partition, columns) as writer:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= RECORD_BATCH_ROWS:
+                writer.write_records(batch)
+                batch = []
+        writer.write_records(batch)
+    return writer.rows
@@ -0,0 +1,134 @@
+import os
+import queue
+import threading as th
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+EXECUTORS = ('thread', 'process')
+
+def create_executor(executor='thread', workers=None):
+    workers = workers or os.cpu_count()
+    if executor == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    if executor == 'thread':
+        return ThreadPoolExecutor(max_workers=workers)
+    raise ValueError(f"Unknown executor {executor}, expected one of {EXECUTORS}")
+
+#Runs func over tasks keeping at most max_in_flight submitted at once, yields (task, result)
+#ordered=True yields in task order, otherwise in completion order
+def bounded_map(func, tasks, workers=None, executor='thread', max_in_flight=None, ordered=True):
+    workers = workers or os.cpu_count()
+    if workers == 1 and executor == 'thread':
+        # Serial path: no pool, tasks run in the caller's thread
+        for task in tasks:
+            yield task, func(*task)
+        return
+
+    max_in_flight = max_in_flight or 2 * workers
+    tasks = iter(tasks)
+
+    with create_executor(executor, workers) as pool:
+        in_flight = deque()
+
+        def submit_next():
+            for task in tasks:
+                in_flight.append((task, pool.submit(func, *task)))
+                return True
+            return False
+
+        while len(in_flight) < max_in_flight and submit_next():
+            pass
+
+        while in_flight:
+            if ordered:
+                task, future = in_flight.popleft()
+                result = future.result()
+            else:
+                wait([f for _, f in in_flight], return_when=FIRST_COMPLETED)
+                index = next(i for i, (_, f) in enumerate(in_flight) if f.done())
+                task, future = in_flight[index]
+                del in_flight[index]
+                result = future.result()
+            submit_next()
+            yield task, result
+
+_END = object()
+
+#Runs tasks through a chain of stages, each on its own threads, joined by queues of at most queue_size items
+#stages is a list of (func, threads); the first func gets *task, the next ones the previous func's result
+#Yields (task, result) in completion order; a func returning None ends that task with result None
+#Stages can be sized independently, e.g. readers prefetch the next tasks while the writers are busy
+def pipeline_map(stages, tasks, queue_size=2):
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages] + [queue.Queue()]
+    stop = th.Event()
+    remaining = [max(1, threads) for _, threads in stages]
+    remaining_lock = th.Lock()
+
+    # Blocking put/get that give up once the consumer has stopped, so no thread is left waiting
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def feed():
+        try:
+            for task in tasks:
+                if not put(queues[0], (task, task, None)):
+                    return
+        except Exception as e:
+            put(queues[0], (None, None, e))
+        put(queues[0], _END)
+
+    def work(index, func):
+        inbox, outbox = queues[index], queues[index + 1]
+        while True:
+            item = get(inbox)
+            if item is _END:
+                # Pass the end marker on to this stage's other threads, the last one closes the next stage
+                put(inbox, _END)
+                with remaining_lock:
+                    remaining[index] -= 1
+                    last = remaining[index] == 0
+                if last:
+                    put(outbox, _END)
+                return
+            task, value, error = item
+            if error is None and value is not None:
+                try:
+                    value = func(*value) if index == 0 else func(value)
+                except Exception as e:
+                    value, error = None, e
+            if not put(outbox, (task, value, error)):
+                return
+
+    threads = [th.Thread(target=feed, daemon=True)]
+    for index, (func, count) in enumerate(stages):
+        threads += [th.Thread(target=work, args=(index, func), daemon=True) for _ in range(max(1, count))]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _END:
+                break
+            task, value, error = item
+            if error is not None:
+                raise error
+            yield task, value
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import signal
+import asyncio
+import datetime as date
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from time_series_functions import ndvi_timeseries_point, ndvi_timeseries_range
+from composite_functions import COMPOSITE_RULES
+from wkt_functions import wkt_to_bounds
+from raster_catalog import ensure_catalog
+from raster_cache import raster_cache_stats
+from metrics import metrics_summary, prometheus_text
+from log_config import logger
+
+RESPONSE_FORMATS = ('json', 'csv')
+DEFAULT_PORT = 8765
+_MAX_BODY_BYTES = 1 << 20
+
+_STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+class QueryError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def _require(params, name):
+    if params.get(name) in (None, ''):
+        raise QueryError(f"Missing parameter {name}")
+    return params[name]
+
+def _parse_date(params, name):
+    try:
+        return date.datetime.strptime(str(_require(params, name)), '%Y-%m-%d')
+    except ValueError:
+        raise QueryError(f"{name} must be in YYYY-MM-DD format")
+
+def _parse_float(params, name):
+    try:
+        return float(_require(params, name))
+    except (TypeError, ValueError):
+        raise QueryError(f"{name} must be a number")
+
+def _parse_composite(params):
+    composite = params.get('composite', 'first_valid')
+    if composite not in COMPOSITE_RULES:
+        raise QueryError(f"composite must be one of {COMPOSITE_RULES}")
+    return composite
+
+def _render(df, response_format):
+    if response_format == 'csv':
+        return 'text/csv', df.to_csv(index=False).encode()
+    return 'application/json', df.to_json(orient='records', date_format='iso').encode()
+
+def _json_body(payload):
+    return 'application/json', json.dumps(payload).encode()
+
+#asyncio HTTP/1.1 server for point and range queries against one NDVI archive
+#The catalog, raster cache and the worker threads' transformers stay warm between requests,
+#and identical queries that arrive while one is running share its result
+class QueryServer:
+    def __init__(self, ndvi_dir, workers=None):
+        self.ndvi_dir = ndvi_dir
+        self.catalog_path = ensure_catalog(ndvi_dir)
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count(), thread_name_prefix='query')
+        self._in_flight = {}
+        self.started = time.time()
+        self.counters = dict.fromkeys(['requests', 'queries', 'coalesced', 'errors'], 0)
+
+    #Runs func on the pool, or joins the identical query that is already running
+    async def _coalesced(self, key, func, *args):
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.counters['coalesced'] += 1
+        else:
+            self.counters['queries'] += 1
+            future = asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield: a client that disconnects must not cancel the query for the others waiting on it
+        return await asyncio.shield(future)
+
+    def health(self):
+        return dict(self.counters, uptime_s=round(time.time() - self.started, 1), in_flight=len(self._in_flight),
+                    catalog=self.catalog_path, raster_cache=raster_cache_stats())
+
+    #Stage timings and counters since start, plus the request counters and raster cache, in Prometheus text format
+    def prometheus_metrics(self):
+        summary = metrics_summary('serve', server=dict(self.counters, in_flight=len(self._in_flight)), raster_cache=raster_cache_stats())
+        return 'text/plain; version=0.0.4', prometheus_text(summary).encode()
+
+    async def query_point(self, params):
+        latitude, longitude = _parse_float(params, 'lat'), _parse_float(params, 'lon')
+        start_date, end_date = _parse_date(params, 'start'), _parse_date(params, 'end')
+        composite = _parse_composite(params)
+        key = ('point', latitude, longitude, start_date, end_date, composite)
+        return await self._coalesced(key, ndvi_timeseries_point, latitude, longitude, start_date, end_date, self.ndvi_dir,
+                                     1, 'thread', composite)
+
+    async def query_range(self, params):
+        wkt_string = str(_require(params, 'wkt')).strip()
+        start_date, end_date = _parse_date(params, 'start'), _parse_date(params, 'end')
+        composite = _parse_composite(params)
+        if wkt_to_bounds(wkt_string) is None:
+            raise QueryError("wkt must be a Point, Polygon or MultiPolygon")
+        key = ('range', wkt_string, start_date, end_date, composite)
+        return await self._coalesced(key, ndvi_timeseries_range, wkt_string, start_date, end_date, self.ndvi_dir,
+                                     1, 'thread', composite)
+
+    async def dispatch(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if method not in ('GET', 'POST'):
+            raise QueryError(f"Method {method} is not allowed", 405)
+        if method == 'POST' and body:
+            try:
+                params.update(json.loads(body))
+            except (ValueError, TypeError):
+                raise QueryError("Request body must be a JSON object")
+
+        if url.path == '/health':
+            return _json_body(self.health())
+        if url.path == '/metrics':
+            return self.prometheus_metrics()
+        if url.path not in ('/point', '/range'):
+            raise QueryError(f"Unknown endpoint {url.path}", 404)
+
+        response_format = params.get('format', 'json')
+        if response_format not in RESPONSE_FORMATS:
+            raise QueryError(f"format must be one of {RESPONSE_FORMATS}")
+        if url.path == '/point':
+            df = await self.query_point(params)
+        else:
+            df = await self.query_range(params)
+        return _render(df, response_format)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                self.counters['requests'] += 1
+                length = int(headers.get('content-length', 0))
+                try:
+                    if length > _MAX_BODY_BYTES:
+                        raise QueryError("Request body is too large", 413)
+                    body = await reader.readexactly(length) if length else b''
+                    status = 200
+                    content_type, payload = await self.dispatch(method.upper(), target, body)
+                except QueryError as e:
+                    status = e.status
+                    content_type, payload = _json_body({'error': str(e)})
+                except Exception as e:
+                    logger.error(f"Error answering {target}: {e}")
+                    status = 500
+                    content_type, payload = _json_body({'error': str(e)})
+                if status != 200:
+                    self.counters['errors'] += 1
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close' and status != 413
+                writer.write((f"{version} {status} {_STATUS_TEXT[status]}\r\n"
+                              f"Content-Type: {content_type}\r\n"
+                              f"Content-Length: {len(payload)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None):
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+            logger.info(f"Serving {self.ndvi_dir} on unix socket {socket_path}")
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            logger.info(f"Serving {self.ndvi_dir} on http://{host}:{port}")
+        serving = asyncio.ensure_future(server.serve_forever())
+        try:
+            # SIGTERM (service managers, kill) stops the server like Ctrl+C does
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, serving.cancel)
+        except NotImplementedError:
+            pass
+        async with server:
+            try:
+                await serving
+            except asyncio.CancelledError:
+                logger.info("Query server stopped")
+
+def run_query_server(ndvi_dir, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None, workers=None):
+    server = QueryServer(ndvi_dir, workers)
+    try:
+        asyncio.run(server.serve(host, port, socket_path))
+    except KeyboardInterrupt:
+        logger.info("Query server stopped")
+    finally:
+        server.pool.shutdown(cancel_futures=True)
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,217 @@
+import os
+import threading as th
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import rasterio as rio
+import rasterio.windows
+
+DEFAULT_MAX_OPEN = 16
+DEFAULT_MAX_MB = 256
+# The query server answers queries all over the archive, and a point query alone touches one scene per date:
+# with 16 handles every query reopens its files
+DEFAULT_SERVER_MAX_OPEN = 256
+
+#Process-wide cache under the series extraction: an LRU of open dataset handles bounded by count
+#and an LRU of decoded blocks keyed by (path, file version, band, block row, block col) bounded by bytes;
+#the file version is its (mtime_ns, size), so blocks of a rewritten file are never served even after its handle was evicted
+class RasterCache:
+    def __init__(self, max_open=DEFAULT_MAX_OPEN, max_bytes=DEFAULT_MAX_MB << 20):
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self._handles = OrderedDict()
+        self._handles_lock = th.Lock()
+        self._blocks = OrderedDict()
+        self._blocks_lock = th.Lock()
+        self._block_bytes = 0
+        self._counters = dict.fromkeys(['handle_hits', 'handle_misses', 'handle_evictions',
+                                        'block_hits', 'block_misses', 'block_evictions', 'decoded_bytes'], 0)
+
+    def configure(self, max_open=None, max_bytes=None):
+        if max_open is not None:
+            self.max_open = max_open
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._evict_handles()
+        with self._blocks_lock:
+            self._evict_blocks()
+
+    def stats(self):
+        with self._handles_lock, self._blocks_lock:
+            stats = dict(self._counters)
+            stats.update(open_handles=len(self._handles), max_open=self.max_open,
+                         cached_blocks=len(self._blocks), cached_bytes=self._block_bytes, max_bytes=self.max_bytes)
+        return stats
+
+    def clear(self):
+        with self._handles_lock:
+            handles = list(self._handles.values())
+            self._handles.clear()
+        for dataset, _, lock in handles:
+            with lock:
+                dataset.close()
+        with self._blocks_lock:
+            self._blocks.clear()
+            self._block_bytes = 0
+
+    def _evict_handles(self):
+        evicted = []
+        with self._handles_lock:
+            while len(self._handles) > max(self.max_open, 1):
+                evicted.append(self._handles.popitem(last=False)[1])
+                self._counters['handle_evictions'] += 1
+        for dataset, _, lock in evicted:
+            with lock:
+                dataset.close()
+
+    def _drop_blocks(self, file_path):
+        with self._blocks_lock:
+            for key in [key for key in self._blocks if key[0] == file_path]:
+                self._block_bytes -= self._blocks.pop(key).nbytes
+
+    def _lookup(self, file_path, version):
+        with self._handles_lock:
+            entry = self._handles.get(file_path)
+            if entry is None or entry[1] != version:
+                return None
+            self._counters['handle_hits'] += 1
+            self._handles.move_to_end(file_path)
+            return entry
+
+    #Files are opened outside the lock so a slow open (network storage) does not block readers of other files;
+    #when two threads open the same file at once, the first handle inserted wins and the other one is closed
+    def _entry(self, file_path):
+        stat = os.stat(file_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        entry = self._lookup(file_path, version)
+        if entry is not None:
+            return entry
+
+        dataset = rio.open(file_path)
+        unused, stale = None, None
+        with self._handles_lock:
+            entry = self._handles.get(file_path)
+            if entry is not None and entry[1] == version:
+                self._counters['handle_hits'] += 1
+                unused = dataset
+            else:
+                if entry is not None:
+                    stale = self._handles.pop(file_path)
+                self._counters['handle_misses'] += 1
+                entry = (dataset, version, th.Lock())
+                self._handles[file_path] = entry
+            self._handles.move_to_end(file_path)
+
+        if unused is not None:
+            unused.close()
+        if stale is not None:
+            # The file was rewritten since it was opened; its old blocks can no longer be hit, so free them now
+            self._drop_blocks(file_path)
+            with stale[2]:
+                stale[0].close()
+        self._evict_handles()
+        return entry
+
+    #Yields an open (dataset, version, lock) entry; the per-handle lock keeps one reader per handle at a time
+    @contextmanager
+    def _locked_entry(self, file_path):
+        while True:
+            entry = self._entry(file_path)
+            with entry[2]:
+                # Another thread may have evicted and closed the handle before the lock was taken
+                if entry[0].closed:
+                    continue
+                yield entry
+                return
+
+    @contextmanager
+    def open(self, file_path):
+        with self._locked_entry(file_path) as (dataset, _, _):
+            yield dataset
+
+    def _evict_blocks(self):
+        while self._block_bytes > self.max_bytes and self._blocks:
+            self._block_bytes -= self._blocks.popitem(last=False)[1].nbytes
+            self._counters['block_evictions'] += 1
+
+    def _get_block(self, key):
+        with self._blocks_lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                self._counters['block_hits'] += 1
+            else:
+                self._counters['block_misses'] += 1
+            return block
+
+    def _put_block(self, key, block):
+        if block.nbytes > self.max_bytes:
+            return
+        with self._blocks_lock:
+            if key in self._blocks:
+                return
+            self._blocks[key] = block
+            self._block_bytes += block.nbytes
+            self._evict_blocks()
+
+    #Reads a window through the block cache; missing blocks are fetched with one read of their bounding rectangle
+    def read_window(self, file_path, window, band=1):
+        with self._locked_entry(file_path) as (dataset, version, _):
+            block_height, block_width = dataset.block_shapes[band - 1]
+            height, width = dataset.height, dataset.width
+            row_start, col_start = int(window.row_off), int(window.col_off)
+            row_stop, col_stop = row_start + int(window.height), col_start + int(window.width)
+            block_rows = range(row_start // block_height, (row_stop - 1) // block_height + 1)
+            block_cols = range(col_start // block_width, (col_stop - 1) // block_width + 1)
+
+            blocks = {}
+            missing = []
+            for bi in block_rows:
+                for bj in block_cols:
+                    block = self._get_block((file_path, version, band, bi, bj))
+                    if block is None:
+                        missing.append((bi, bj))
+                    else:
+                        blocks[(bi, bj)] = block
+
+            if missing:
+                mi0, mi1 = min(m[0] for m in missing), max(m[0] for m in missing)
+                mj0, mj1 = min(m[1] for m in missing), max(m[1] for m in missing)
+                r0, c0 = mi0 * block_height, mj0 * block_width
+                r1, c1 = min((mi1 + 1) * block_height, height), min((mj1 + 1) * block_width, width)
+                data = dataset.read(band, window=rio.windows.Window(c0, r0, c1 - c0, r1 - r0))
+                with self._blocks_lock:
+                    self._counters['decoded_bytes'] += data.nbytes
+                for bi, bj in missing:
+                    block = data[bi * block_height - r0:min((bi + 1) * block_height, height) - r0,
+                                 bj * block_width - c0:min((bj + 1) * block_width, width) - c0].copy()
+                    blocks[(bi, bj)] = block
+                    self._put_block((file_path, version, band, bi, bj), block)
+            dtype = dataset.dtypes[band - 1]
+
+        out = np.empty((row_stop - row_start, col_stop - col_start), dtype=dtype)
+        for (bi, bj), block in blocks.items():
+            br0, bc0 = bi * block_height, bj * block_width
+            r0, r1 = max(row_start, br0), min(row_stop, br0 + block.shape[0])
+            c0, c1 = max(col_start, bc0), min(col_stop, bc0 + block.shape[1])
+            out[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = block[r0 - br0:r1 - br0, c0 - bc0:c1 - bc0]
+        return out
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+raster_cache = RasterCache(max_open=_env_int('NDVI_CACHE_MAX_OPEN', DEFAULT_MAX_OPEN),
+                           max_bytes=_env_int('NDVI_CACHE_MAX_MB', DEFAULT_MAX_MB) << 20)
+
+#Handle limit of the query server: NDVI_CACHE_MAX_OPEN when set, DEFAULT_SERVER_MAX_OPEN otherwise
+def server_max_open():
+    return _env_int('NDVI_CACHE_MAX_OPEN', DEFAULT_SERVER_MAX_OPEN)
+
+def configure_raster_cache(max_open=None, max_mb=None):
+    raster_cache.configure(max_open=max_open, max_bytes=None if max_mb is None else int(max_mb) << 20)
+
+def raster_cache_stats():
+    return raster_cache.stats()
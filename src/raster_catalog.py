@@ -0,0 +1,265 @@
+import os
+import json
+import sqlite3
+import threading as th
+import datetime as date
+from log_config import logger
+
+CATALOG_FILE_NAME = 'raster_catalog.sqlite'
+
+# Serializes writers inside one process; sqlite handles locking between processes
+_catalog_lock = th.Lock()
+
+# WAL lets queries read while an ingest writes, but needs the catalog on a local disk: its shared-memory index does not
+# work over NFS/SMB. Set NDVI_CATALOG_JOURNAL_MODE=DELETE for archives on network storage
+JOURNAL_MODES = ('WAL', 'DELETE')
+DEFAULT_JOURNAL_MODE = 'WAL'
+FALLBACK_JOURNAL_MODE = 'DELETE'
+
+# Catalog files whose schema and journal mode were set up by this process, by (path, device, inode)
+_initialized = set()
+_initialized_lock = th.Lock()
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS scenes (
+        id INTEGER PRIMARY KEY,
+        date TEXT NOT NULL,
+        path TEXT NOT NULL UNIQUE,
+        file_name TEXT NOT NULL,
+        crs TEXT,
+        geotransform TEXT,
+        width INTEGER,
+        height INTEGER,
+        min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL,
+        valid_pixels INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS scenes_date ON scenes(date)",
+    # 3D R-tree over lon, lat and day number so space and time are answered by one lookup
+    """CREATE VIRTUAL TABLE IF NOT EXISTS scene_rtree USING rtree(
+        id, min_lon, max_lon, min_lat, max_lat, min_day, max_day
+    )""",
+    # Incremental ingest: what each output was built from, and which input folders are fully done
+    """CREATE TABLE IF NOT EXISTS manifest (
+        output_path TEXT PRIMARY KEY,
+        dir TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        red_size INTEGER, red_mtime_ns INTEGER,
+        nir_size INTEGER, nir_mtime_ns INTEGER,
+        params TEXT,
+        output_size INTEGER,
+        output_sha256 TEXT,
+        processed_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS directories (
+        dir TEXT PRIMARY KEY,
+        mtime_ns INTEGER,
+        params TEXT
+    )""",
+]
+
+def get_catalog_path(ndvi_dir):
+    return os.path.join(ndvi_dir, CATALOG_FILE_NAME)
+
+def catalog_journal_mode():
+    mode = os.environ.get('NDVI_CATALOG_JOURNAL_MODE', DEFAULT_JOURNAL_MODE).upper()
+    if mode not in JOURNAL_MODES:
+        logger.warning(f"Unknown NDVI_CATALOG_JOURNAL_MODE {mode}, expected one of {JOURNAL_MODES}; using {DEFAULT_JOURNAL_MODE}")
+        return DEFAULT_JOURNAL_MODE
+    return mode
+
+#Both modes are stored in the catalog file, so they are set once per process; falls back to DELETE where WAL cannot be set
+def _set_journal_mode(conn, catalog_path):
+    mode = catalog_journal_mode()
+    try:
+        applied = conn.execute(f'PRAGMA journal_mode={mode}').fetchone()[0].upper()
+    except sqlite3.OperationalError as e:
+        applied = str(e)
+    if applied != mode:
+        logger.warning(f"Could not set journal mode {mode} on {catalog_path} ({applied}), using {FALLBACK_JOURNAL_MODE}")
+        conn.execute(f'PRAGMA journal_mode={FALLBACK_JOURNAL_MODE}')
+
+def _initialize_catalog(conn, catalog_path):
+    _set_journal_mode(conn, catalog_path)
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    # Catalogs written before the per-date compositing rules have no valid pixel counts
+    if 'valid_pixels' not in {row['name'] for row in conn.execute('PRAGMA table_info(scenes)')}:
+        with conn:
+            conn.execute('ALTER TABLE scenes ADD COLUMN valid_pixels INTEGER')
+
+#The schema is created once per catalog file and process, not on every connection; a catalog that was deleted and
+#recreated has a new inode and is set up again
+def connect_catalog(catalog_path):
+    conn = sqlite3.connect(catalog_path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    stat = os.stat(catalog_path)
+    key = (os.path.abspath(catalog_path), stat.st_dev, stat.st_ino)
+    with _initialized_lock:
+        if key not in _initialized:
+            _initialize_catalog(conn, catalog_path)
+            _initialized.add(key)
+    return conn
+
+# Read queries reuse one connection per thread and catalog, so a long-running process keeps it warm
+_readers = th.local()
+
+def _reader_connection(catalog_path):
+    connections = getattr(_readers, 'connections', None)
+    if connections is None:
+        connections = _readers.connections = {}
+    conn = connections.get(catalog_path)
+    if conn is None:
+        conn = connections[catalog_path] = connect_catalog(catalog_path)
+    return conn
+
+def _to_date_string(value):
+    if isinstance(value, str):
+        return value
+    return value.strftime('%Y-%m-%d')
+
+def _to_day_number(value):
+    return date.datetime.strptime(_to_date_string(value), '%Y-%m-%d').toordinal()
+
+def _relative_to_catalog(catalog_path, path):
+    return os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(catalog_path)))
+
+#valid_pixels is the number of non-nodata pixels, used by the least_nodata compositing rule
+def add_scene_to_catalog(catalog_path, scene_date, raster_path, crs, geotransform, width, height, mbr, valid_pixels=None):
+    rel_path = _relative_to_catalog(catalog_path, raster_path)
+    file_name = os.path.splitext(os.path.basename(raster_path))[0]
+    date_string = _to_date_string(scene_date)
+    day = _to_day_number(date_string)
+    min_lon, min_lat, max_lon, max_lat = mbr
+
+    with _catalog_lock:
+        conn = connect_catalog(catalog_path)
+        try:
+            with conn:
+                row = conn.execute('SELECT id FROM scenes WHERE path = ?', (rel_path,)).fetchone()
+                if row is not None:
+                    conn.execute('DELETE FROM scene_rtree WHERE id = ?', (row['id'],))
+                    conn.execute('DELETE FROM scenes WHERE id = ?', (row['id'],))
+                cursor = conn.execute(
+                    'INSERT INTO scenes (date, path, file_name, crs, geotransform, width, height, '
+                    'min_lon, min_lat, max_lon, max_lat, valid_pixels) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (date_string, rel_path, file_name, str(crs), json.dumps(list(geotransform)),
+                     int(width), int(height), min_lon, min_lat, max_lon, max_lat,
+                     None if valid_pixels is None else int(valid_pixels)))
+                conn.execute('INSERT INTO scene_rtree VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (cursor.lastrowid, min_lon, max_lon, min_lat, max_lat, day, day))
+        finally:
+            conn.close()
+
+def _row_to_scene(row, root):
+    scene = dict(row)
+    scene['path'] = os.path.join(root, scene['path'])
+    scene['geotransform'] = tuple(json.loads(scene['geotransform'])) if scene['geotransform'] else None
+    scene['mbr'] = [scene['min_lon'], scene['min_lat'], scene['max_lon'], scene['max_lat']]
+    return scene
+
+#takes bounds as: [min_lon, min_lat, max_lon, max_lat], a point is passed with min == max
+def query_scenes(catalog_path, start_date, end_date, bounds):
+    root = os.path.dirname(os.path.abspath(catalog_path))
+    min_lon, min_lat, max_lon, max_lat = bounds
+    start_string, end_string = _to_date_string(start_date), _to_date_string(end_date)
+
+    conn = _reader_connection(catalog_path)
+    # The R-tree stores 32-bit floats rounded outwards, so refine against the exact columns
+    rows = conn.execute(
+        'SELECT s.* FROM scene_rtree r JOIN scenes s ON s.id = r.id '
+        'WHERE r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ? '
+        'AND r.max_day >= ? AND r.min_day <= ? '
+        'AND s.max_lon >= ? AND s.min_lon <= ? AND s.max_lat >= ? AND s.min_lat <= ? '
+        'AND s.date BETWEEN ? AND ? '
+        'ORDER BY s.date, s.id',
+        (min_lon, max_lon, min_lat, max_lat,
+         _to_day_number(start_string) - 1, _to_day_number(end_string) + 1,
+         min_lon, max_lon, min_lat, max_lat,
+         start_string, end_string)).fetchall()
+
+    return [_row_to_scene(row, root) for row in rows]
+
+def query_dates(catalog_path, start_date, end_date):
+    conn = _reader_connection(catalog_path)
+    rows = conn.execute('SELECT DISTINCT date FROM scenes WHERE date BETWEEN ? AND ? ORDER BY date',
+                        (_to_date_string(start_date), _to_date_string(end_date))).fetchall()
+    return [row['date'] for row in rows]
+
+def load_manifest(catalog_path):
+    conn = connect_catalog(catalog_path)
+    try:
+        rows = conn.execute('SELECT * FROM manifest').fetchall()
+    finally:
+        conn.close()
+    return {row['output_path']: dict(row) for row in rows}
+
+def record_manifest_entry(catalog_path, output_path, dir, file_name, signature, params, output_size, output_sha256):
+    with _catalog_lock:
+        conn = connect_catalog(catalog_path)
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO manifest (output_path, dir, file_name, red_size, red_mtime_ns, '
+                    'nir_size, nir_mtime_ns, params, output_size, output_sha256, processed_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (_relative_to_catalog(catalog_path, output_path), dir, file_name,
+                     signature['red_size'], signature['red_mtime_ns'], signature['nir_size'], signature['nir_mtime_ns'],
+                     params, output_size, output_sha256, date.datetime.now().isoformat(timespec='seconds')))
+        finally:
+            conn.close()
+
+def load_directory_states(catalog_path):
+    conn = connect_catalog(catalog_path)
+    try:
+        rows = conn.execute('SELECT * FROM directories').fetchall()
+    finally:
+        conn.close()
+    return {row['dir']: dict(row) for row in rows}
+
+def record_directory_state(catalog_path, dir, mtime_ns, params):
+    with _catalog_lock:
+        conn = connect_catalog(catalog_path)
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO directories (dir, mtime_ns, params) VALUES (?, ?, ?)',
+                             (dir, mtime_ns, params))
+        finally:
+            conn.close()
+
+def build_catalog_from_directories(ndvi_dir):
+    # One-off migration for archives processed before the catalog existed
+    import rasterio as rio
+    import numpy as np
+    from bounding_box_functions import get_raster_metadata
+
+    catalog_path = get_catalog_path(ndvi_dir)
+    for dir in sorted(os.listdir(ndvi_dir)):
+        curr_dir = os.path.join(ndvi_dir, dir)
+        if not os.path.isdir(curr_dir):
+            continue
+        try:
+            date.datetime.strptime(dir, '%Y-%m-%d')
+        except ValueError:
+            continue
+
+        for image in sorted(os.listdir(curr_dir)):
+            if not image.endswith('.tif'):
+                continue
+            raster_path = os.path.join(curr_dir, image)
+            try:
+                metadata = get_raster_metadata(raster_path)
+                with rio.open(raster_path) as dataset:
+                    metadata['valid_pixels'] = np.count_nonzero(dataset.read(1))
+                add_scene_to_catalog(catalog_path, dir, raster_path, **metadata)
+            except Exception as e:
+                logger.warning(f"Error cataloging image {raster_path}: {e}")
+
+    logger.info(f"Catalog built at {catalog_path}")
+    return catalog_path
+
+def ensure_catalog(ndvi_dir):
+    catalog_path = get_catalog_path(ndvi_dir)
+    if not os.path.isfile(catalog_path):
+        logger.info(f"No catalog found in {ndvi_dir}, building one from the date directories")
+        build_catalog_from_directories(ndvi_dir)
+    return catalog_path
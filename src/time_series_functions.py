@@ -1,112 +1,272 @@
 import os
 import datetime as date
-from bounding_box_functions import *
-from ndvi_extraction_functions import *
-import pandas as pd
-from ndvi_image_functions import denormalize_ndvi
+import numpy as np
+from bounding_box_functions import inBoundingBox_point
+from wkt_functions import wkt_to_bounds
+from ndvi_kernel import denormalize_ndvi
+from raster_catalog import ensure_catalog, query_scenes, query_dates
+from parallel_functions import bounded_map
+from ndvi_cube import attach_cubes
+from composite_functions import COMPOSITE_RULES, group_scenes_by_date, preload_point_history, preload_range_history, composite_point_value, composite_point_values, composite_range_histogram, composite_zonal_histograms
+from metrics import stage_timer, count_metric, run_with_metrics, merged_results
 from log_config import logger
 
-def ndvi_timeseries_point(latitude, longitude, start_date, end_date, search_dir):
-    search_files = os.listdir(search_dir)
-    time_series = []
+#Runs one per-scene (or per-date) extraction inside a pool; errors come back as values so the caller logs them in order
+def _scene_task(func, *args):
+    try:
+        with stage_timer('extract'):
+            return func(*args), None
+    except Exception as e:
+        return None, e
 
-    for file in search_files:
-        try:
-            year, month, day = file.split('-')
-            year, month, day = int(year), int(month), int(day)
-            curr_date = date.datetime(year, month, day)
-
-            if start_date <= curr_date <= end_date:
-                curr_dir = os.path.join(search_dir, file)
-                curr_list = os.listdir(curr_dir)
-                curr_list = [f for f in curr_list if f.endswith('.tif')]
-
-                point_found = False
-
-                for image in curr_list:
-                    try:
-                        raster_path = os.path.join(curr_dir, 'raster_index.csv')
-                        raster_df = pd.read_csv(raster_path)
-                        curr_mbr = wkt_to_bounds(raster_df.loc[raster_df['FileName'] == image.split('.')[0], 'MBR'].iloc[0])
-                        
-                        if inBoundingBox_point(latitude, longitude, curr_mbr):
-                            path = os.path.join(curr_dir, image)
-                            pixel_val = get_ndvi_value_from_latlon(latitude, longitude, path)
-                            denormalize_pixel_val = denormalize_ndvi(pixel_val)
-                            
-                            if pixel_val != 0:
-                                time_series.append({
-                                    'Date': curr_date,
-                                    'File': image,
-                                    'PixelValue': denormalize_pixel_val
-                                })
-                                logger.info(f"Date: {curr_date}: {pixel_val}")
-                                point_found = True
-                                break  
-                        else:
-                            logger.info(f'Point not in {image}')
-                    except Exception as e:
-                        logger.warning(f"Error processing image {image}: {e}")
-
-                if point_found:
-                    break  
+#Per-scene (or per-date group) results in catalog order, extracted on up to `jobs` workers with a bounded in-flight window
+def _map_scenes(func, scenes, args, jobs=1, executor='thread'):
+    tasks = ((func,) + tuple(args(scene)) for scene in scenes)
+    if executor == 'process':
+        # The extract timings of the workers are merged into this process's metrics
+        tasks = ((_scene_task,) + task for task in tasks)
+        results = merged_results(bounded_map(run_with_metrics, tasks, workers=jobs, executor=executor, max_in_flight=4 * jobs))
+    else:
+        results = bounded_map(_scene_task, tasks, workers=jobs, executor=executor, max_in_flight=4 * jobs)
+    for scene, (_, result) in zip(scenes, results):
+        yield scene, result
 
-        except Exception as e:
-            logger.warning(f"Error processing file {file}: {e}")
+POINT_COLUMNS = ['Date', 'File', 'PixelValue']
+RANGE_COLUMNS = ['Date', 'NDVI_MIN', 'NDVI_MAX', 'NDVI_MEDIAN', 'NDVI_MEAN']
+POINTS_COLUMNS = ['PointID', 'Date', 'File', 'NDVI']
+ZONAL_COLUMNS = ['ParcelID', 'Date', 'NDVI_MIN', 'NDVI_MAX', 'NDVI_MEDIAN', 'NDVI_MEAN', 'PixelCount']
+#Rows of the per-date series are handed out in DataFrames of about this many rows
+SERIES_BATCH_ROWS = 512
+
+#pandas is only imported where DataFrames are built: iter_point_records gives a point series without it
+#Groups row dicts into DataFrames of batch_rows rows
+def _batched_frames(rows, batch_rows=SERIES_BATCH_ROWS):
+    import pandas as pd
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_rows:
+            yield pd.DataFrame(batch)
+            batch = []
+    if batch:
+        yield pd.DataFrame(batch)
 
-    df = pd.DataFrame(time_series)
-    return df
+#The whole series of one of the iter_* generators as one DataFrame
+def _collect_frames(frames, columns):
+    import pandas as pd
+    chunks = list(frames)
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
 
-def ndvi_timeseries_range(wkt_string, start_date, end_date, search_dir):
-    search_files = os.listdir(search_dir)
-    time_series = []
+#One row per date with a valid pixel; overlapping scenes of a date are merged with the `composite` rule
+def ndvi_timeseries_point(latitude, longitude, start_date, end_date, search_dir, jobs=1, executor='thread', composite='first_valid'):
+    frames = iter_ndvi_timeseries_point(latitude, longitude, start_date, end_date, search_dir, jobs, executor, composite)
+    return _collect_frames(frames, POINT_COLUMNS)
 
-    for file in search_files:
+#Same series handed out in DataFrames of up to batch_rows rows, in date order, as the dates are extracted
+def iter_ndvi_timeseries_point(latitude, longitude, start_date, end_date, search_dir, jobs=1, executor='thread', composite='first_valid', batch_rows=SERIES_BATCH_ROWS):
+    records = iter_point_records(latitude, longitude, start_date, end_date, search_dir, jobs, executor, composite)
+    yield from _batched_frames(records, batch_rows)
+
+#Same series as one dict per row (POINT_COLUMNS), on rasterio and NumPy alone
+def iter_point_records(latitude, longitude, start_date, end_date, search_dir, jobs=1, executor='thread', composite='first_valid'):
+    if composite not in COMPOSITE_RULES:
+        raise ValueError(f"Unknown compositing rule {composite}, expected one of {COMPOSITE_RULES}")
+    with stage_timer('query_scan'):
+        catalog_path = ensure_catalog(search_dir)
+        scenes = query_scenes(catalog_path, start_date, end_date, [longitude, latitude, longitude, latitude])
+        # Scenes in a cube built with process_ndvi.py --build-cube are read from it instead of their files
+        attach_cubes(search_dir, scenes)
+    count_metric('scenes_scanned', len(scenes))
+    with stage_timer('extract'):
+        preload_point_history(scenes, latitude, longitude)
+
+    groups = group_scenes_by_date(scenes)
+    for group, (result, error) in _map_scenes(composite_point_value, groups, lambda g: (g, latitude, longitude, composite), jobs, executor):
         try:
-            year, month, day = file.split('-')
-            year, month, day = int(year), int(month), int(day)
-            curr_date = date.datetime(year, month, day)
-
-            if start_date <= curr_date <= end_date:
-                curr_dir = os.path.join(search_dir, file)
-                curr_list = os.listdir(curr_dir)
-                curr_list = [f for f in curr_list if f.endswith('.tif')]
-
-                curr_ndvi_values = []
-                raster_path = os.path.join(curr_dir, 'raster_index.csv')
-                raster_df = pd.read_csv(raster_path)
-                for image in curr_list:
-                    try:
-                        curr_mbr = wkt_to_bounds(raster_df.loc[raster_df['FileName'] == image.split('.')[0], 'MBR'].iloc[0])
-                        
-                        if inBoundingBox_range(wkt_string, curr_mbr):
-                            path = os.path.join(curr_dir, image)
-                            aoi_values = get_ndvi_from_range(wkt_string, path)
-                            curr_ndvi_values.extend(aoi_values)
-                    except Exception as e:
-                        logger.warning(f"Error processing image {image}: {e}")
-
-                ndvi_values_array = np.array(curr_ndvi_values)
-
-                if ndvi_values_array.size == 0:
-                    min_val, max_val, median_val, mean_val = np.nan, np.nan, np.nan, np.nan
-                else:
-                    ndvi_values_denormalized = denormalize_ndvi(ndvi_values_array)
-                    min_val = np.nanmin(ndvi_values_denormalized)
-                    max_val = np.nanmax(ndvi_values_denormalized)
-                    median_val = np.nanmedian(ndvi_values_denormalized)
-                    mean_val = np.nanmean(ndvi_values_denormalized)
-
-                time_series.append({
-                    'Date': curr_date,
-                    'NDVI_MIN': min_val,
-                    'NDVI_MAX': max_val,
-                    'NDVI_MEDIAN': median_val,
-                    'NDVI_MEAN': mean_val,
-                })
+            if error is not None:
+                raise error
+            pixel_val, scene = result
+            if pixel_val is None:
+                continue
+            curr_date = date.datetime.strptime(scene['date'], '%Y-%m-%d')
+            logger.debug(f"Date: {curr_date}: {pixel_val}")
+            yield {
+                'Date': curr_date,
+                'File': os.path.basename(scene['path']),
+                'PixelValue': denormalize_ndvi(pixel_val)
+            }
+        except Exception as e:
+            logger.warning(f"Error processing date {group[0]['date']}: {e}")
+
+#Min, max, median and mean of the NDVI values counted in 256-bin histograms of the uint8 encoding
+#Works on one histogram or a (zones, 256) stack; empty histograms give NaN
+def histogram_statistics(histogram):
+    histogram = np.asarray(histogram)
+    count = histogram.sum(axis=-1)
+    bins = histogram.shape[-1]
+    values = denormalize_ndvi(np.arange(bins, dtype=float))
+    present = histogram > 0
+    cumulative = np.cumsum(histogram, axis=-1)
+    # Same as np.nanmedian: average of the two middle values when the count is even
+    lower = np.minimum((cumulative <= ((count - 1) // 2)[..., None]).sum(axis=-1), bins - 1)
+    upper = np.minimum((cumulative <= (count // 2)[..., None]).sum(axis=-1), bins - 1)
+
+    empty = count == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        min_val = np.where(empty, np.nan, values[np.argmax(present, axis=-1)])
+        max_val = np.where(empty, np.nan, values[bins - 1 - np.argmax(present[..., ::-1], axis=-1)])
+        median_val = np.where(empty, np.nan, (values[lower] + values[upper]) / 2)
+        mean_val = (histogram * values).sum(axis=-1) / count
+    if histogram.ndim == 1:
+        return float(min_val), float(max_val), float(median_val), float(mean_val)
+    return min_val, max_val, median_val, mean_val
+
+#One row per catalog date; every AOI pixel is counted once per date, overlapping scenes are merged with the `composite` rule
+def ndvi_timeseries_range(wkt_string, start_date, end_date, search_dir, jobs=1, executor='thread', composite='first_valid'):
+    frames = iter_ndvi_timeseries_range(wkt_string, start_date, end_date, search_dir, jobs, executor, composite)
+    return _collect_frames(frames, RANGE_COLUMNS)
+
+def iter_ndvi_timeseries_range(wkt_string, start_date, end_date, search_dir, jobs=1, executor='thread', composite='first_valid', batch_rows=SERIES_BATCH_ROWS):
+    if composite not in COMPOSITE_RULES:
+        raise ValueError(f"Unknown compositing rule {composite}, expected one of {COMPOSITE_RULES}")
+    with stage_timer('query_scan'):
+        catalog_path = ensure_catalog(search_dir)
+        mbr = wkt_to_bounds(wkt_string)
+        scenes = query_scenes(catalog_path, start_date, end_date, mbr)
+        attach_cubes(search_dir, scenes)
+    count_metric('scenes_scanned', len(scenes))
+    with stage_timer('extract'):
+        preload_range_history(scenes, wkt_string)
+
+    # Dates with a scene over the AOI come back from the pool in date order, the other catalog dates get empty rows
+    def rows():
+        groups = group_scenes_by_date(scenes)
+        results = _map_scenes(composite_range_histogram, groups, lambda g: (g, wkt_string, composite), jobs, executor)
+        next_result = next(results, None)
+        for curr_day in query_dates(catalog_path, start_date, end_date):
+            histogram = np.zeros(256, dtype=np.int64)
+            while next_result is not None and next_result[0][0]['date'] <= curr_day:
+                group, (group_histogram, error) = next_result
+                if error is not None:
+                    logger.warning(f"Error processing date {group[0]['date']}: {error}")
+                elif group[0]['date'] == curr_day:
+                    histogram = group_histogram
+                next_result = next(results, None)
 
+            min_val, max_val, median_val, mean_val = histogram_statistics(histogram)
+            yield {
+                'Date': date.datetime.strptime(curr_day, '%Y-%m-%d'),
+                'NDVI_MIN': min_val,
+                'NDVI_MAX': max_val,
+                'NDVI_MEDIAN': median_val,
+                'NDVI_MEAN': mean_val,
+            }
+
+    yield from _batched_frames(rows(), batch_rows)
+
+#Long-format series for many points: one row per (point, date) with a valid pixel, overlapping scenes of a date
+#are merged with the `composite` rule like in the point series; File is the scene the value came from
+def ndvi_timeseries_points(points_df, start_date, end_date, search_dir, jobs=1, executor='thread', composite='first_valid'):
+    frames = iter_ndvi_timeseries_points(points_df, start_date, end_date, search_dir, jobs, executor, composite)
+    return _collect_frames(frames, POINTS_COLUMNS)
+
+#Same rows handed out as one DataFrame per date, in date order
+def iter_ndvi_timeseries_points(points_df, start_date, end_date, search_dir, jobs=1, executor='thread', composite='first_valid'):
+    import pandas as pd
+    if composite not in COMPOSITE_RULES:
+        raise ValueError(f"Unknown compositing rule {composite}, expected one of {COMPOSITE_RULES}")
+    catalog_path = ensure_catalog(search_dir)
+    point_ids = points_df['PointID'].to_numpy()
+    latitudes = points_df['Latitude'].to_numpy(dtype=float)
+    longitudes = points_df['Longitude'].to_numpy(dtype=float)
+    if len(points_df) == 0:
+        return
+
+    bounds = [longitudes.min(), latitudes.min(), longitudes.max(), latitudes.max()]
+
+    groups = []
+    with stage_timer('query_scan'):
+        scenes = query_scenes(catalog_path, start_date, end_date, bounds)
+        attach_cubes(search_dir, scenes)
+        for group in group_scenes_by_date(scenes):
+            # Points inside the footprint of any scene of the date
+            candidates = np.zeros(len(points_df), dtype=bool)
+            for scene in group:
+                candidates |= inBoundingBox_point(latitudes, longitudes, scene['mbr'])
+            if candidates.any():
+                groups.append((group, np.nonzero(candidates)[0]))
+    count_metric('scenes_scanned', sum(len(group) for group, _ in groups))
+
+    point_args = lambda g: (g[0], latitudes[g[1]], longitudes[g[1]], composite)
+    for (group, candidates), (result, error) in _map_scenes(composite_point_values, groups, point_args, jobs, executor):
+        curr_day = group[0]['date']
+        if error is not None:
+            logger.warning(f"Error processing date {curr_day}: {error}")
+            continue
+        pixel_vals, sources, ordered = result
+        valid = sources >= 0
+        if not valid.any():
+            continue
+        files = np.array([os.path.basename(scene['path']) for scene in ordered])
+        logger.debug(f"Date: {curr_day}: {int(valid.sum())} points from {len(ordered)} scenes")
+        yield pd.DataFrame({
+            'PointID': point_ids[candidates[valid]],
+            'Date': date.datetime.strptime(curr_day, '%Y-%m-%d'),
+            'File': files[sources[valid]],
+            'NDVI': denormalize_ndvi(pixel_vals[valid].astype(float)),
+        })
+#Long-format zonal series: one row per (parcel, date) with valid pixels; every parcel pixel is counted once per date,
+#overlapping scenes are merged with the `composite` rule like in the range series
+#zones_gdf comes from load_zones_file (ParcelID + geometry in EPSG:4326)
+def ndvi_zonal_timeseries(zones_gdf, start_date, end_date, search_dir, composite='first_valid'):
+    return _collect_frames(iter_ndvi_zonal_timeseries(zones_gdf, start_date, end_date, search_dir, composite), ZONAL_COLUMNS)
+
+#Same rows handed out as one DataFrame per date, in date order
+def iter_ndvi_zonal_timeseries(zones_gdf, start_date, end_date, search_dir, composite='first_valid'):
+    import pandas as pd
+    from shapely.geometry import box
+    if composite not in COMPOSITE_RULES:
+        raise ValueError(f"Unknown compositing rule {composite}, expected one of {COMPOSITE_RULES}")
+    catalog_path = ensure_catalog(search_dir)
+    if len(zones_gdf) == 0:
+        return
+
+    parcel_ids = zones_gdf['ParcelID'].to_numpy()
+    spatial_index = zones_gdf.sindex
+    cache = {}
+
+    with stage_timer('query_scan'):
+        scenes = query_scenes(catalog_path, start_date, end_date, list(zones_gdf.total_bounds))
+        attach_cubes(search_dir, scenes)
+    count_metric('scenes_scanned', len(scenes))
+
+    for group in group_scenes_by_date(scenes):
+        curr_day = group[0]['date']
+        # Parcels whose bounding box overlaps a scene of the date
+        zone_indices = np.unique(np.concatenate([spatial_index.query(box(*scene['mbr'])) for scene in group]))
+        if zone_indices.size == 0:
+            continue
+        try:
+            with stage_timer('extract'):
+                histograms = composite_zonal_histograms(group, zones_gdf, zone_indices, composite, cache)
         except Exception as e:
-            logger.warning(f"Error processing file {file}: {e}")
+            logger.warning(f"Error processing date {curr_day}: {e}")
+            continue
 
-    df = pd.DataFrame(time_series)
-    return df
\ No newline at end of file
+        counts = histograms.sum(axis=1)
+        rows = np.nonzero(counts)[0]
+        if rows.size == 0:
+            continue
+        min_val, max_val, median_val, mean_val = histogram_statistics(histograms[rows])
+        logger.debug(f"Date: {curr_day}: {rows.size} parcels")
+        yield pd.DataFrame({
+            'ParcelID': parcel_ids[zone_indices[rows]],
+            'Date': date.datetime.strptime(curr_day, '%Y-%m-%d'),
+            'NDVI_MIN': min_val,
+            'NDVI_MAX': max_val,
+            'NDVI_MEDIAN': median_val,
+            'NDVI_MEAN': mean_val,
+            'PixelCount': counts[rows],
+        })
@@ -1,36 +1,26 @@
-from pyproj import Transformer
-from shapely.geometry import mapping, Point, Polygon
-import geopandas as gpd
-import rioxarray as rxr
-import numpy as np
-from shapely import wkt
-from shapely.geometry import mapping, Point, Polygon
+from crs_functions import transform_bounds
+from log_config import logger
+#shapely, geopandas and pandas are imported inside the functions that need them, a point query loads none of them
 def wkt_to_bounds(wkt_string, src_crs='EPSG:4326', dst_crs='EPSG:4326'):
     try:
+        from shapely import wkt
+        from shapely.geometry import Point, Polygon, MultiPolygon
         geometry = wkt.loads(wkt_string)
-        if isinstance(geometry, Polygon):
+        if isinstance(geometry, (Polygon, MultiPolygon)):
             min_lon, min_lat, max_lon, max_lat = geometry.bounds
         elif isinstance(geometry, Point):
             min_lon, min_lat = geometry.x, geometry.y
             max_lon, max_lat = min_lon, min_lat
         else:
-            raise ValueError("Only Point and Polygon geometries are accepted.")
+            raise ValueError("Only Point, Polygon and MultiPolygon geometries are accepted.")
         
-        if src_crs != dst_crs:
-            transformer = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
-            min_lon, min_lat = transformer.transform(min_lon, min_lat)
-            max_lon, max_lat = transformer.transform(max_lon, max_lat)
-        
-        return [min_lon, min_lat, max_lon, max_lat]
+        return transform_bounds(min_lon, min_lat, max_lon, max_lat, src_crs, dst_crs)
     except Exception as e:
         print(f"Error Opening Geometry: {e}")
         return None
 
 def bounds_to_wkt(min_lon, min_lat, max_lon, max_lat, src_crs='EPSG:4326', dst_crs='EPSG:4326'):
-    transformer = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
-    
-    min_lon, min_lat = transformer.transform(min_lon, min_lat)
-    max_lon, max_lat = transformer.transform(max_lon, max_lat)
+    min_lon, min_lat, max_lon, max_lat = transform_bounds(min_lon, min_lat, max_lon, max_lat, src_crs, dst_crs)
     
     wkt_polygon = f"POLYGON (({min_lon} {min_lat}, {max_lon} {min_lat}, {max_lon} {max_lat}, {min_lon} {max_lat}, {min_lon} {min_lat}))"
     return wkt_polygon
@@ -40,6 +30,57 @@ def import_wkt_file():
 
 
 def load_wkt_as_geodataframe(wkt_string, crs='EPSG:4326'):
+    import geopandas as gpd
+    from shapely import wkt
     geometry = wkt.loads(wkt_string)
     gdf = gpd.GeoDataFrame({'geometry': [geometry]}, crs=crs)
-    return gdf
\ No newline at end of file
+    return gdf
+
+#Loads a CSV (point_id, latitude, longitude) or any vector file of points into PointID, Latitude, Longitude columns
+def load_points_file(points_path, crs='EPSG:4326'):
+    import pandas as pd
+    if points_path.lower().endswith('.csv'):
+        points_df = pd.read_csv(points_path)
+        columns = {c.lower(): c for c in points_df.columns}
+        lat_col = columns.get('latitude', columns.get('lat'))
+        lon_col = columns.get('longitude', columns.get('lon'))
+        id_col = columns.get('point_id', columns.get('id'))
+        if lat_col is None or lon_col is None:
+            raise ValueError("Points CSV needs latitude/lat and longitude/lon columns.")
+        latitudes = points_df[lat_col].to_numpy(dtype=float)
+        longitudes = points_df[lon_col].to_numpy(dtype=float)
+        point_ids = points_df[id_col].to_numpy() if id_col is not None else points_df.index.to_numpy()
+    else:
+        import geopandas as gpd
+        points_gdf = gpd.read_file(points_path)
+        if points_gdf.crs is not None:
+            points_gdf = points_gdf.to_crs(crs)
+        if not (points_gdf.geometry.geom_type == 'Point').all():
+            raise ValueError("Only Point geometries are accepted in a points file.")
+        columns = {c.lower(): c for c in points_gdf.columns}
+        id_col = columns.get('point_id', columns.get('id'))
+        latitudes = points_gdf.geometry.y.to_numpy()
+        longitudes = points_gdf.geometry.x.to_numpy()
+        point_ids = points_gdf[id_col].to_numpy() if id_col is not None else points_gdf.index.to_numpy()
+
+    return pd.DataFrame({'PointID': point_ids, 'Latitude': latitudes, 'Longitude': longitudes})
+
+#Loads parcels from any vector file (GeoPackage, shapefile, GeoJSON) into ParcelID + geometry columns
+def load_zones_file(zones_path, id_field=None, crs='EPSG:4326'):
+    import geopandas as gpd
+    zones_gdf = gpd.read_file(zones_path)
+    if zones_gdf.crs is not None:
+        zones_gdf = zones_gdf.to_crs(crs)
+    else:
+        zones_gdf = zones_gdf.set_crs(crs)
+
+    is_polygon = zones_gdf.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])
+    if not is_polygon.all():
+        logger.warning(f"Skipping {int((~is_polygon).sum())} features of {zones_path} that are not Polygon or MultiPolygon geometries")
+        zones_gdf = zones_gdf[is_polygon]
+
+    if id_field is not None:
+        parcel_ids = zones_gdf[id_field].to_numpy()
+    else:
+        parcel_ids = zones_gdf.index.to_numpy()
+    return gpd.GeoDataFrame({'ParcelID': parcel_ids}, geometry=zones_gdf.geometry.to_numpy(), crs=zones_gdf.crs).reset_index(drop=True)
@@ -2,69 +2,170 @@ import sys
 import os
 import argparse
 import datetime as date
-import logging
 
 # Add directories to sys.path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
 # Import functions
-from bounding_box_functions import *
-from ndvi_extraction_functions import *
-from ndvi_image_functions import *
-from time_series_functions import *
-from wkt_functions import *
-from log_config import logger, console_handler
-def handle_point_timeseries(lat, lon, start_date, end_date, ndvi_dir):
+# Only what a point query needs is imported here: geopandas, shapely, pandas and pyarrow load inside the modes that use them
+from time_series_functions import (iter_point_records, iter_ndvi_timeseries_range, iter_ndvi_timeseries_points, iter_ndvi_zonal_timeseries,
+                                   POINT_COLUMNS, RANGE_COLUMNS, POINTS_COLUMNS, ZONAL_COLUMNS)
+from wkt_functions import wkt_to_bounds, load_points_file, load_zones_file
+from parallel_functions import EXECUTORS
+from composite_functions import COMPOSITE_RULES
+from raster_cache import configure_raster_cache, raster_cache_stats, server_max_open
+from output_functions import write_series, write_series_records, SERIES_FORMATS, NDVI_DTYPES, PARTITIONS
+from metrics import report_metrics, profiled, METRICS_FORMATS, PROFILERS
+from log_config import logger, set_console_level
+#output_options: output (path, default derived from the query), output_format, ndvi_dtype and partition, see write_series
+#Rows are written as the dates complete; the chunks are only formatted into the log when DEBUG is on
+def handle_point_timeseries(lat, lon, start_date, end_date, ndvi_dir, jobs=1, executor='thread', composite='first_valid', **output_options):
     try:
-        time_series_point = ndvi_timeseries_point(lat, lon, start_date, end_date, ndvi_dir)
-        file_name = f"{start_date.date()}_to_{end_date.date()}_at_Longitude_{lon}_and_Latitude_{lat}.csv"
-        time_series_point.to_csv(file_name, index=False)
-        logger.info(f"Point time series saved to {file_name}")
-        logger.debug(f"Time series data: {time_series_point}")
+        # Rows are written as plain records, a csv point series never imports pandas
+        records = iter_point_records(lat, lon, start_date, end_date, ndvi_dir, jobs, executor, composite)
+        file_name = f"{start_date.date()}_to_{end_date.date()}_at_Longitude_{lon}_and_Latitude_{lat}"
+        file_name, rows = save_series(records, file_name, POINT_COLUMNS, records=True, **output_options)
+        logger.info(f"Point time series saved to {file_name} ({rows} rows)")
     except Exception as e:
         logger.error(f"Error processing point time series: {e}")
 
-def handle_range_timeseries(wkt, start_date, end_date, ndvi_dir):
+def handle_range_timeseries(wkt, start_date, end_date, ndvi_dir, jobs=1, executor='thread', composite='first_valid', **output_options):
     try:
-        time_series_range = ndvi_timeseries_range(wkt, start_date, end_date, ndvi_dir)
+        frames = iter_ndvi_timeseries_range(wkt, start_date, end_date, ndvi_dir, jobs, executor, composite)
         mbr = wkt_to_bounds(wkt)
-        file_name = f"{start_date.date()}_to_{end_date.date()}_at_{mbr}.csv"
-        time_series_range.to_csv(file_name, index=False)
-        logger.info(f"Range time series saved to {file_name}")
-        logger.debug(f"Time series data: {time_series_range}")
+        file_name = f"{start_date.date()}_to_{end_date.date()}_at_{mbr}"
+        file_name, rows = save_series(frames, file_name, RANGE_COLUMNS, **output_options)
+        logger.info(f"Range time series saved to {file_name} ({rows} rows)")
     except Exception as e:
         logger.error(f"Error processing range time series: {e}")
 
+def handle_points_timeseries(points_path, start_date, end_date, ndvi_dir, jobs=1, executor='thread', composite='first_valid', **output_options):
+    try:
+        points_df = load_points_file(points_path)
+        frames = iter_ndvi_timeseries_points(points_df, start_date, end_date, ndvi_dir, jobs, executor, composite)
+        points_name = os.path.splitext(os.path.basename(points_path))[0]
+        file_name = f"{start_date.date()}_to_{end_date.date()}_at_points_{points_name}"
+        file_name, rows = save_series(frames, file_name, POINTS_COLUMNS, **output_options)
+        logger.info(f"Points time series saved to {file_name} ({rows} rows)")
+    except Exception as e:
+        logger.error(f"Error processing points time series: {e}")
+
+def handle_zonal_timeseries(zones_path, start_date, end_date, ndvi_dir, id_field=None, composite='first_valid', **output_options):
+    try:
+        zones_gdf = load_zones_file(zones_path, id_field)
+        frames = iter_ndvi_zonal_timeseries(zones_gdf, start_date, end_date, ndvi_dir, composite)
+        zones_name = os.path.splitext(os.path.basename(zones_path))[0]
+        file_name = f"{start_date.date()}_to_{end_date.date()}_at_zones_{zones_name}"
+        output_options.setdefault('output_format', 'parquet')
+        file_name, rows = save_series(frames, file_name, ZONAL_COLUMNS, **output_options)
+        logger.info(f"Zonal time series saved to {file_name} ({rows} rows)")
+    except Exception as e:
+        logger.error(f"Error processing zonal time series: {e}")
+
+#Writes to output, or to default_name plus the format's extension; the zonal series defaults to parquet, the others to csv
+#records=True: chunks are row dicts instead of DataFrames
+def save_series(chunks, default_name, columns, records=False, output=None, output_format=None, ndvi_dtype='float32', partition='none'):
+    output_format = output_format or 'csv'
+    file_name = output or f"{default_name}.{output_format}"
+    write = write_series_records if records else write_series
+    rows = write(chunks, file_name, output_format, ndvi_dtype, partition, columns)
+    return file_name, rows
+
+def serve_main(argv):
+    from query_server import run_query_server, DEFAULT_PORT
+    parser = argparse.ArgumentParser(prog='timeseries.py serve', description='Serve point and range time series queries over HTTP')
+    parser.add_argument('-i', '--input', metavar='input_directory', type=str, required=True, help='Input directory of NDVI images')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'TCP port to listen on (default: {DEFAULT_PORT})')
+    parser.add_argument('--socket', metavar='path', type=str, help='Listen on a Unix socket instead of TCP')
+    parser.add_argument('-j', '--jobs', metavar='jobs', type=int, help='Queries answered in parallel (default: number of CPUs)')
+    parser.add_argument('--cache-max-open', metavar='files', type=int, default=server_max_open(), help='Maximum open raster handles kept in the cache (default: NDVI_CACHE_MAX_OPEN or 256)')
+    parser.add_argument('--cache-mb', metavar='megabytes', type=int, help='Maximum decoded block cache size in MB (default: NDVI_CACHE_MAX_MB or 256)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Turns off Messages until WARNING LEVEL')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Also log per-date extraction details')
+    args = parser.parse_args(argv)
+
+    set_console_level(args.quiet, args.verbose)
+
+    configure_raster_cache(args.cache_max_open, args.cache_mb)
+    run_query_server(args.input, host=args.host, port=args.port, socket_path=args.socket, workers=args.jobs)
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description='NDVI Image and Time Series Processing')
     parser.add_argument('-i', '--input', metavar='input_directory', type=str, required=True, help='Input directory of NDVI images')
     parser.add_argument('-p', '--point', nargs=2, metavar=('latitude', 'longitude'), type=float, help='Latitude and Longitude for point time series')
+    parser.add_argument('-m', '--points', metavar='points_file', type=str, help='Path to CSV or GeoJSON of points for a batched point time series')
     parser.add_argument('-w', '--wkt', metavar='wkt_file', type=str, help='Path to WKT file for range time series')
+    parser.add_argument('-z', '--zones', metavar='zones_file', type=str, help='Path to a GeoPackage, shapefile or GeoJSON of parcels for zonal statistics')
+    parser.add_argument('--zone-id', metavar='field', type=str, help='Attribute holding the parcel id (default: feature index)')
     parser.add_argument('-s', '--start', metavar='start_date', type=str, required=True, help='Start date in YYYY-MM-DD format')
     parser.add_argument('-e', '--end', metavar='end_date', type=str, required=True, help='End date in YYYY-MM-DD format')
+    parser.add_argument('-j', '--jobs', metavar='jobs', type=int, default=1, help='Number of scenes extracted in parallel (default: 1)')
+    parser.add_argument('--executor', choices=EXECUTORS, default='thread', help='Run parallel extraction on a thread or process pool (default: thread)')
+    parser.add_argument('--composite', choices=COMPOSITE_RULES, default='first_valid', help='How overlapping scenes of one date are merged in every series (default: first_valid)')
+    parser.add_argument('-o', '--output', metavar='path', type=str, help='Write the series here instead of a name derived from the query (only with one of -p/-m/-w/-z)')
+    parser.add_argument('--format', choices=SERIES_FORMATS, help='Output format (default: parquet for --zones, csv otherwise; csv is gzip-compressed when the path ends in .gz)')
+    parser.add_argument('--ndvi-dtype', choices=NDVI_DTYPES, default='float32', help='Type of the NDVI columns; uint8 stores single-pixel values as the archive\'s 1..255 codes (default: float32)')
+    parser.add_argument('--partition-by', choices=PARTITIONS, default='none', help='Write parquet as a directory with one year=YYYY partition per year (default: none)')
+    parser.add_argument('--cache-max-open', metavar='files', type=int, help='Maximum open raster handles kept in the cache (default: NDVI_CACHE_MAX_OPEN or 16)')
+    parser.add_argument('--cache-mb', metavar='megabytes', type=int, help='Maximum decoded block cache size in MB (default: NDVI_CACHE_MAX_MB or 256)')
+    parser.add_argument('--metrics', metavar='path', type=str, help='Write stage timings, counters and cache statistics of the run to this file')
+    parser.add_argument('--metrics-format', choices=METRICS_FORMATS, default='json', help='json (overwrite), jsonl (append one line per run) or prom (Prometheus textfile) (default: json)')
+    parser.add_argument('--profile', choices=PROFILERS, help='Run under cProfile or tracemalloc and log the top entries')
+    parser.add_argument('--profile-out', metavar='path', type=str, help='With --profile, write the full profile (pstats file or allocation report) here')
     parser.add_argument('-q', '--quiet', action='store_true', help='Turns off Messages until WARNING LEVEL')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Also log per-date extraction details and the full result tables')
     args = parser.parse_args()
+    if args.output and sum(bool(mode) for mode in (args.point, args.points, args.wkt, args.zones)) > 1:
+        parser.error('--output can only be used with one of --point, --points, --wkt and --zones')
+    if args.partition_by != 'none' and args.format == 'csv':
+        parser.error('--partition-by needs --format parquet')
 
     ndvi_dir = args.input
     start_date = date.datetime.strptime(args.start, '%Y-%m-%d')
     end_date = date.datetime.strptime(args.end, '%Y-%m-%d')
 
-    quiet = args.quiet
-    if quiet:
-        console_handler.setLevel(logging.ERROR)
-    else:
-        console_handler.setLevel(logging.DEBUG)
-    
+    set_console_level(args.quiet, args.verbose)
+    configure_raster_cache(args.cache_max_open, args.cache_mb)
+
+    with profiled(args.profile, args.profile_out):
+        run_queries(args, ndvi_dir, start_date, end_date)
+
+    report_metrics('timeseries', args.metrics, args.metrics_format, raster_cache=raster_cache_stats())
+
+def run_queries(args, ndvi_dir, start_date, end_date):
+    output_options = dict(output=args.output, ndvi_dtype=args.ndvi_dtype, partition=args.partition_by)
+    if args.format:
+        output_options['output_format'] = args.format
+    elif args.partition_by != 'none':
+        output_options['output_format'] = 'parquet'
+
     if args.point:
         latitude, longitude = args.point
-        handle_point_timeseries(latitude, longitude, start_date, end_date, ndvi_dir)
+        handle_point_timeseries(latitude, longitude, start_date, end_date, ndvi_dir, args.jobs, args.executor, args.composite, **output_options)
+
+    if args.points:
+        if os.path.isfile(args.points):
+            handle_points_timeseries(args.points, start_date, end_date, ndvi_dir, args.jobs, args.executor, args.composite, **output_options)
+        else:
+            logger.warning(f"The points file {args.points} does not exist.")
+
+    if args.zones:
+        if os.path.exists(args.zones):
+            handle_zonal_timeseries(args.zones, start_date, end_date, ndvi_dir, args.zone_id, args.composite, **output_options)
+        else:
+            logger.warning(f"The zones file {args.zones} does not exist.")
 
     if args.wkt:
         wkt_path = args.wkt
         if os.path.isfile(wkt_path):
             with open(wkt_path, 'r') as file:
                 wkt_string = file.read()
-            handle_range_timeseries(wkt_string, start_date, end_date, ndvi_dir)
+            handle_range_timeseries(wkt_string, start_date, end_date, ndvi_dir, args.jobs, args.executor, args.composite, **output_options)
         else:
             logger.warning(f"The WKT file {wkt_path} does not exist.")
     